@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Latency, throughput and quality benchmarks for the GODEL serving options
+
+    python GODEL/benchmark.py quantization --model_name_or_path CKPT --validation_file dstc9_val.jsonl
+    python GODEL/benchmark.py onnx --model_name_or_path CKPT --onnx_dir CKPT-onnx --validation_file dstc9_val.jsonl
+    python GODEL/benchmark.py speculative --model_name_or_path LARGE --draft_model_name_or_path BASE --validation_file dstc9_val.jsonl
+    python GODEL/benchmark.py static_decoding --model_name_or_path CKPT --validation_file dstc9_val.jsonl --num_beams 5 --compile
+    python GODEL/benchmark.py logits_processors --batch_sizes '[1,8,32]' --num_beams 5
+    python GODEL/benchmark.py scheduling --model_name_or_path CKPT --validation_file dstc9_val.jsonl --rate 10
+"""
+
+import json
+import os
+import random
+import threading
+import time
+
+import fire
+import jsonlines
+import numpy as np
+import torch
+from nltk.translate.bleu_score import SmoothingFunction, corpus_bleu
+
+from transformers import LogitsProcessorList, MinLengthLogitsProcessor, NoRepeatNGramLogitsProcessor
+
+from GODEL import server
+from GODEL.utils.batching import MicroBatcher
+from GODEL.utils.logits_processors import MinLengthProcessor, NoRepeatNGramProcessor
+from GODEL.utils.scheduling import SchedulingQueue, get_policy
+from GODEL.utils.text_normalization import normalize_answer
+
+# the same inputs are generated more than once (warm-up, repeated runs, one
+# run per setting), cached encoder outputs would skip the encoder after the
+# first time
+server.args.encoder_cache_max_bytes = 0
+
+
+def load_examples(validation_file, num_examples=None):
+    """
+    Examples in the training data format ({Context, Knowledge, Response}).
+    """
+    examples = []
+    with jsonlines.open(validation_file) as reader:
+        for example in reader:
+            examples.append(example)
+            if num_examples and len(examples) >= num_examples:
+                break
+    return examples
+
+
+def latency_stats(latencies):
+    latencies = np.array(latencies) * 1000
+    return {
+        'mean_ms': round(float(latencies.mean()), 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p90_ms': round(float(np.percentile(latencies, 90)), 2),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+    }
+
+
+def bleu(predictions, references):
+    return round(100 * corpus_bleu(
+        [[normalize_answer(reference).split()] for reference in references],
+        [normalize_answer(prediction).split() for prediction in predictions],
+        smoothing_function=SmoothingFunction().method1,
+    ), 2)
+
+
+def run_examples(examples, batch_size=1, generate_batch=None):
+    """
+    Generate a response for every example, `batch_size` at a time. Returns
+    the predictions, the per-batch latencies and the throughput.
+    """
+    generate_batch = generate_batch or server.generate_batch
+    predictions, latencies = [], []
+    start = time.perf_counter()
+    for i in range(0, len(examples), batch_size):
+        batch = examples[i:i + batch_size]
+        batch_start = time.perf_counter()
+        predictions.extend(generate_batch([example['Context'] for example in batch],
+                                          [example['Knowledge'] for example in batch]))
+        latencies.append(time.perf_counter() - batch_start)
+    elapsed = time.perf_counter() - start
+    return predictions, latencies, len(examples) / elapsed
+
+
+def evaluate(examples, batch_size=1, generate_batch=None):
+    references = [example['Response'] for example in examples]
+    predictions, latencies, throughput = run_examples(examples, 1, generate_batch)
+    _, _, batch_throughput = run_examples(examples, batch_size, generate_batch)
+    return predictions, {
+        'latency': latency_stats(latencies),
+        'throughput_per_s': round(throughput, 2),
+        f'throughput_per_s_batch_{batch_size}': round(batch_throughput, 2),
+        'bleu': bleu(predictions, references),
+    }
+
+
+def tune_threads(examples, thread_counts=None):
+    """
+    Mean single-request latency for each intra-op thread count.
+    """
+    thread_counts = thread_counts or sorted({1, 2, 4, 8, 16, os.cpu_count()})
+    default_threads = torch.get_num_threads()
+    results = {}
+    for num_threads in thread_counts:
+        if num_threads > os.cpu_count():
+            continue
+        torch.set_num_threads(num_threads)
+        _, latencies, _ = run_examples(examples)
+        results[num_threads] = latency_stats(latencies)['mean_ms']
+    torch.set_num_threads(default_threads)
+    return results
+
+
+def quantization(model_name_or_path, validation_file, num_examples=100, batch_size=8,
+                 num_threads=None, thread_counts=None):
+    """
+    Compare fp32 and int8 dynamically quantized CPU serving: latency,
+    throughput, BLEU against the references and agreement with fp32.
+    """
+    server.args.model_name_or_path = model_name_or_path
+    server.args.device = 'cpu'
+    server.args.num_threads = num_threads
+    server.main()
+    examples = load_examples(validation_file, num_examples)
+    warmup = examples[:2]
+
+    report = {}
+    run_examples(warmup)
+    fp32_predictions, report['fp32'] = evaluate(examples, batch_size)
+
+    server.model = server.quantize_dynamic(server.model)
+    run_examples(warmup)
+    int8_predictions, report['int8'] = evaluate(examples, batch_size)
+    report['int8']['threads_mean_ms'] = tune_threads(examples[:10], thread_counts)
+
+    report['delta'] = {
+        'bleu': round(report['int8']['bleu'] - report['fp32']['bleu'], 2),
+        'agreement_with_fp32': round(float(np.mean(
+            [a == b for a, b in zip(fp32_predictions, int8_predictions)])), 4),
+        'speedup_p50': round(report['fp32']['latency']['p50_ms'] / report['int8']['latency']['p50_ms'], 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+def onnx(model_name_or_path, onnx_dir, validation_file, num_examples=100, batch_size=8, num_threads=None):
+    """
+    Compare eager PyTorch and onnxruntime (graphs from export_onnx.py) CPU
+    serving: latency, throughput and agreement of the greedy outputs.
+    """
+    server.args.device = 'cpu'
+    server.args.num_threads = num_threads
+    examples = load_examples(validation_file, num_examples)
+    warmup = examples[:2]
+
+    report, predictions = {}, {}
+    for backend, path in [('torch', model_name_or_path), ('onnx', onnx_dir)]:
+        server.args.backend = backend
+        server.args.model_name_or_path = path
+        server.main()
+        run_examples(warmup)
+        predictions[backend], report[backend] = evaluate(examples, batch_size)
+
+    report['delta'] = {
+        'agreement_with_torch': round(float(np.mean(
+            [a == b for a, b in zip(predictions['torch'], predictions['onnx'])])), 4),
+        'speedup_p50': round(report['torch']['latency']['p50_ms'] / report['onnx']['latency']['p50_ms'], 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+def speculative(model_name_or_path, draft_model_name_or_path, validation_file, num_examples=100,
+                num_speculative_tokens=4, device=None):
+    """
+    Plain greedy decoding against speculative decoding with a draft model:
+    tokens/sec, draft acceptance rate and agreement of the outputs.
+    """
+    server.args.model_name_or_path = model_name_or_path
+    server.args.device = device or ('cuda:0' if torch.cuda.is_available() else 'cpu')
+    server.args.draft_model_name_or_path = draft_model_name_or_path
+    server.args.num_speculative_tokens = num_speculative_tokens
+    server.main()
+    examples = load_examples(validation_file, num_examples)
+    decoder = server.speculative
+
+    report, predictions = {}, {}
+    for mode in ('greedy', 'speculative'):
+        server.speculative = decoder if mode == 'speculative' else None
+        decoder.reset_stats()
+        predictions[mode], latencies, _ = run_examples(examples)
+        tokens = sum(len(ids) for ids in server.tokenizer(predictions[mode]).input_ids)
+        report[mode] = {
+            'latency': latency_stats(latencies),
+            'tokens_per_s': round(tokens / sum(latencies), 2),
+        }
+    report['speculative'].update({
+        'acceptance_rate': round(decoder.stats()['acceptance_rate'], 4),
+        'draft_tokens_per_s': round(decoder.stats()['tokens_per_s'], 2),
+    })
+    report['delta'] = {
+        'agreement_with_greedy': round(float(np.mean(
+            [a == b for a, b in zip(predictions['greedy'], predictions['speculative'])])), 4),
+        'speedup_p50': round(report['greedy']['latency']['p50_ms'] / report['speculative']['latency']['p50_ms'], 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+def static_decoding(model_name_or_path, validation_file, num_examples=100, batch_size=1, num_beams=1,
+                    compile=False, device=None):
+    """
+    model.generate() against the static-shape decode loop with a
+    preallocated KV cache (optionally torch.compile'd): per-token latency,
+    throughput and agreement of the outputs.
+    """
+    server.args.model_name_or_path = model_name_or_path
+    server.args.device = device or ('cuda:0' if torch.cuda.is_available() else 'cpu')
+    server.args.static_decoding = True
+    server.args.compile = compile
+    server.main()
+    examples = load_examples(validation_file, num_examples)
+    decoder = server.static_decoder
+
+    def generate_batch(contexts, knowledges):
+        return server.generate_batch(contexts, knowledges, params={'num_beams': num_beams})
+
+    report, predictions = {}, {}
+    for mode in ('generate', 'static'):
+        server.static_decoder = decoder if mode == 'static' else None
+        # the first batches of a shape pay for compilation
+        run_examples(examples[:2 * batch_size], batch_size, generate_batch)
+        predictions[mode], latencies, throughput = run_examples(examples, batch_size, generate_batch)
+        tokens = sum(len(ids) for ids in server.tokenizer(predictions[mode]).input_ids)
+        report[mode] = {
+            'latency': latency_stats(latencies),
+            'ms_per_token': round(1000 * sum(latencies) / tokens, 3),
+            'throughput_per_s': round(throughput, 2),
+        }
+    report['delta'] = {
+        'agreement_with_generate': round(float(np.mean(
+            [a == b for a, b in zip(predictions['generate'], predictions['static'])])), 4),
+        'speedup_per_token': round(report['generate']['ms_per_token'] / report['static']['ms_per_token'], 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+def logits_processors(batch_sizes=(1, 8, 32), num_beams=1, lengths=(16, 64, 128), vocab_size=32128,
+                      ngram_size=4, min_length=32, repeats=20, device=None):
+    """
+    Per-step overhead of transformers' n-gram blocking and min-length
+    processors against the tensorized ones on random histories of
+    batch x beams rows, and whether they ban the same tokens.
+    """
+    device = device or ('cuda:0' if torch.cuda.is_available() else 'cpu')
+    stock = LogitsProcessorList([NoRepeatNGramLogitsProcessor(ngram_size), MinLengthLogitsProcessor(min_length, 1)])
+    tensorized = LogitsProcessorList([NoRepeatNGramProcessor(ngram_size), MinLengthProcessor(min_length, 1)])
+    report = []
+    for batch_size in batch_sizes:
+        for length in lengths:
+            rows = batch_size * num_beams
+            # a small alphabet so that n-grams actually repeat
+            input_ids = torch.randint(0, 50, (rows, length), device=device)
+            scores = torch.randn(rows, vocab_size, device=device)
+            result = {'rows': rows, 'length': length}
+            outputs = {}
+            for name, processors in (('stock', stock), ('tensorized', tensorized)):
+                outputs[name] = processors(input_ids, scores.clone())
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    processors(input_ids, scores.clone())
+                server.synchronize(torch.device(device))
+                result[name + '_ms_per_step'] = round(1000 * (time.perf_counter() - start) / repeats, 3)
+            result['identical'] = bool(torch.equal(outputs['stock'], outputs['tensorized']))
+            result['speedup'] = round(result['stock_ms_per_step'] / result['tensorized_ms_per_step'], 2)
+            report.append(result)
+    print(json.dumps(report, indent=2))
+
+
+def scheduling(model_name_or_path, validation_file, num_requests=200, batch_fraction=0.2, rate=10.0,
+               policies=('fifo', 'sjf', 'priority'), max_batch_size=8, seed=0, device=None):
+    """
+    Replay the same open-loop mix of cheap interactive requests (greedy,
+    short replies) and expensive batch requests (beam search, long replies)
+    arriving at `rate` per second through the micro-batcher under each
+    queue policy, and report the latency of each class.
+    """
+    server.args.model_name_or_path = model_name_or_path
+    server.args.device = device or ('cuda:0' if torch.cuda.is_available() else 'cpu')
+    server.main()
+    examples = load_examples(validation_file, num_requests)
+    rng = random.Random(seed)
+    workload = []
+    for i in range(num_requests):
+        example = examples[i % len(examples)]
+        if rng.random() < batch_fraction:
+            priority, params = 'batch', {'num_beams': 4, 'min_length': 32, 'max_length': 128}
+        else:
+            priority, params = 'interactive', {'min_length': 4, 'max_length': 32}
+        workload.append(({'msg': example['Context'], 'knowledge': example['Knowledge'],
+                          'params': params, 'priority': priority}, rng.expovariate(rate)))
+
+    def batch_fn(in_requests, stop=None):
+        outputs = [None] * len(in_requests)
+        groups = {}
+        for i, in_request in enumerate(in_requests):
+            groups.setdefault(json.dumps(in_request['params'], sort_keys=True), []).append(i)
+        for indices in groups.values():
+            responses = server.generate_batch([in_requests[i]['msg'] for i in indices],
+                                              [in_requests[i]['knowledge'] for i in indices],
+                                              params=in_requests[indices[0]]['params'])
+            for i, response in zip(indices, responses):
+                outputs[i] = response
+        return outputs
+
+    def cost(item):
+        params = item[1]['params']
+        return params['max_length'] * params.get('num_beams', 1)
+
+    def priority_class(item):
+        return item[1]['priority']
+
+    report = {}
+    for name in policies:
+        policy = get_policy(name, cost=cost, priority_class=priority_class, delays={'interactive': 0, 'batch': 10})
+        batcher = MicroBatcher(SchedulingQueue(policy=policy), batch_fn, max_batch_size=max_batch_size)
+        latencies = {'interactive': [], 'batch': []}
+        done = threading.Semaphore(0)
+
+        def record(future, priority, submitted):
+            latencies[priority].append(time.perf_counter() - submitted)
+            done.release()
+
+        # the workers of earlier policies keep waiting on their own queues
+        batcher.start()
+        for request_id, (in_request, gap) in enumerate(workload):
+            time.sleep(gap)
+            submitted = time.perf_counter()
+            future = batcher.submit(request_id, in_request)
+            future.add_done_callback(lambda future, priority=in_request['priority'], submitted=submitted:
+                                     record(future, priority, submitted))
+        for _ in workload:
+            done.acquire()
+        report[name] = {priority: latency_stats(values) for priority, values in latencies.items() if values}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'quantization': quantization,
+        'onnx': onnx,
+        'speculative': speculative,
+        'static_decoding': static_decoding,
+        'logits_processors': logits_processors,
+        'scheduling': scheduling,
+    })
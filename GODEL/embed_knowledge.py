@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Embed the knowledge documents offline for dense retrieval at serve time
+
+    python GODEL/embed_knowledge.py --model_name_or_path sentence-transformers/all-MiniLM-L6-v2 \
+        --output_dir data/knowledge_dense --knowledge_path data/knowledge.json --num_lists 1024
+
+writes to output_dir:
+    embeddings.npy     float16 [num_documents, dim] unit rows, memory-mapped by the server
+    meta.json          the document key of every row
+    centroids.npy      with --num_lists: IVF centroids, rows are grouped by list
+    list_offsets.npy   with --num_lists: the rows of list i are offsets[i]:offsets[i + 1]
+"""
+
+import os
+
+import fire
+import numpy as np
+from tqdm import tqdm
+
+from GODEL.utils.dense_retrieval import DenseIndex, TextEncoder
+from GODEL.utils.knowledge_store import KnowledgeStore
+
+
+def embed(model_name_or_path, output_dir, knowledge_path=None, facts_paths=(), num_lists=0,
+          batch_size=64, chunk_size=65536, device='cpu'):
+    encoder = TextEncoder(model_name_or_path, device=device)
+    store = KnowledgeStore(encoder.tokenizer)
+    if knowledge_path:
+        store.load_dstc9(knowledge_path)
+    for path in facts_paths:
+        store.load_facts(path)
+    keys = list(store.docs)
+
+    # embedded to a scratch file first, collections may not fit in RAM
+    os.makedirs(output_dir, exist_ok=True)
+    scratch_path = os.path.join(output_dir, 'embeddings.tmp.npy')
+    scratch = None
+    for start in tqdm(range(0, len(keys), chunk_size)):
+        vectors = encoder.encode([store.docs[key] for key in keys[start:start + chunk_size]], batch_size=batch_size)
+        if scratch is None:
+            scratch = np.lib.format.open_memmap(scratch_path, mode='w+', dtype=np.float16,
+                                                shape=(len(keys), vectors.shape[1]))
+        scratch[start:start + len(vectors)] = vectors
+    scratch.flush()
+
+    DenseIndex.build(output_dir, keys, scratch, num_lists=num_lists)
+    del scratch
+    os.remove(scratch_path)
+    print(f'Embedded {len(keys)} documents with {model_name_or_path} to {output_dir}')
+
+
+if __name__ == '__main__':
+    fire.Fire(embed)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Export a GODEL checkpoint to ONNX for serving with onnxruntime
+
+    python GODEL/export_onnx.py --model_name_or_path CKPT --output_dir CKPT-onnx
+
+writes three graphs next to the config and tokenizer:
+    encoder_model.onnx            input_ids, attention_mask -> encoder_hidden_states
+    decoder_model.onnx            first step, also returns the cross-attention cache
+    decoder_with_past_model.onnx  one token per call, reusing past key/values
+"""
+
+import os
+
+import fire
+import torch
+from transformers import AutoConfig, AutoModelForSeq2SeqLM, AutoTokenizer
+
+
+ENCODER_FILE = 'encoder_model.onnx'
+DECODER_FILE = 'decoder_model.onnx'
+DECODER_WITH_PAST_FILE = 'decoder_with_past_model.onnx'
+
+
+def past_names(num_layers, prefix):
+    names = []
+    for i in range(num_layers):
+        for name in ('decoder.key', 'decoder.value', 'encoder.key', 'encoder.value'):
+            names.append(f'{prefix}.{i}.{name}')
+    return names
+
+
+class EncoderWrapper(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+
+class DecoderWrapper(torch.nn.Module):
+    """
+    One decoder step returning the logits and the flattened past key/values
+    (self-attention key, value, cross-attention key, value per layer).
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.decoder = model.get_decoder()
+        self.lm_head = model.lm_head
+        self.scale = model.config.d_model ** -0.5 if model.config.tie_word_embeddings else 1.0
+        self.num_layers = model.config.num_decoder_layers
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+        past_key_values = None
+        if past:
+            past_key_values = tuple(tuple(past[4 * i:4 * i + 4]) for i in range(self.num_layers))
+        outputs = self.decoder(
+            input_ids=decoder_input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = self.lm_head(outputs.last_hidden_state * self.scale)
+        present = [tensor for layer in outputs.past_key_values for tensor in layer]
+        return (logits, *present)
+
+
+def export(model_name_or_path, output_dir, opset=13):
+    os.makedirs(output_dir, exist_ok=True)
+    config = AutoConfig.from_pretrained(model_name_or_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path, config=config).eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+    config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+
+    num_layers = config.num_decoder_layers
+    input_ids = torch.tensor(tokenizer(['export GODEL to onnx', 'a longer example input for the export'],
+                                       padding=True).input_ids)
+    attention_mask = (input_ids != config.pad_token_id).long()
+    decoder_input_ids = torch.full((2, 1), config.decoder_start_token_id, dtype=torch.long)
+    present = past_names(num_layers, 'present')
+    past = past_names(num_layers, 'past_key_values')
+
+    encoder = EncoderWrapper(model)
+    decoder = DecoderWrapper(model)
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder, (input_ids, attention_mask), os.path.join(output_dir, ENCODER_FILE),
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['encoder_hidden_states'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'encoder_sequence'},
+                'attention_mask': {0: 'batch', 1: 'encoder_sequence'},
+                'encoder_hidden_states': {0: 'batch', 1: 'encoder_sequence'},
+            },
+            opset_version=opset,
+        )
+
+        encoder_hidden_states = encoder(input_ids, attention_mask)
+        decoder_axes = {
+            'decoder_input_ids': {0: 'batch'},
+            'encoder_hidden_states': {0: 'batch', 1: 'encoder_sequence'},
+            'encoder_attention_mask': {0: 'batch', 1: 'encoder_sequence'},
+            'logits': {0: 'batch'},
+        }
+        for name in present:
+            decoder_axes[name] = {0: 'batch', 2: 'encoder_sequence' if '.encoder.' in name else 'past_sequence + 1'}
+        torch.onnx.export(
+            decoder, (decoder_input_ids, encoder_hidden_states, attention_mask),
+            os.path.join(output_dir, DECODER_FILE),
+            input_names=['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask'],
+            output_names=['logits'] + present,
+            dynamic_axes=decoder_axes,
+            opset_version=opset,
+        )
+
+        outputs = decoder(decoder_input_ids, encoder_hidden_states, attention_mask)
+        for name in past:
+            decoder_axes[name] = {0: 'batch', 2: 'encoder_sequence' if '.encoder.' in name else 'past_sequence'}
+        torch.onnx.export(
+            decoder, (decoder_input_ids, encoder_hidden_states, attention_mask, *outputs[1:]),
+            os.path.join(output_dir, DECODER_WITH_PAST_FILE),
+            input_names=['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask'] + past,
+            output_names=['logits'] + present,
+            dynamic_axes=decoder_axes,
+            opset_version=opset,
+        )
+    print(f'Exported {model_name_or_path} to {output_dir}')
+
+
+if __name__ == '__main__':
+    fire.Fire(export)
@@ -3,16 +3,44 @@
 #  Copyright (c) Microsoft Corporation.
 #  Licensed under the MIT license.
 
+import copy
+import gc
+import json
+import logging
+import os
+import time
+import weakref
+from threading import Lock
+
+_import_start = time.perf_counter()
+
 import torch
 import numpy as np
 import dotmap
 
+from GODEL.utils.dense_retrieval import DenseIndex, TextEncoder
+from GODEL.utils.encoder_cache import EncoderCache
+from GODEL.utils.input_builder import InputBuilder
+from GODEL.utils.knowledge_store import KnowledgeStore
+from GODEL.utils.logits_processors import MinLengthProcessor, NoRepeatNGramProcessor
+from GODEL.utils.metrics import metrics
+from GODEL.utils.model_loading import has_safetensors, load_safetensors
+from GODEL.utils.model_registry import ModelRegistry, vocab_fingerprint
+from GODEL.utils.retrieval import BM25Index, fuse_rankings
+from GODEL.utils.speculative import SpeculativeDecoder
 from transformers import (
     AutoConfig,
     AutoModelForSeq2SeqLM,
     AutoTokenizer,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
 )
 
+IMPORT_SECONDS = time.perf_counter() - _import_start
+
+logger = logging.getLogger(__name__)
+
 
 def set_seed(args):
     np.random.seed(args.seed)
@@ -23,6 +51,22 @@ def set_seed(args):
 
 model = None
 tokenizer = None
+knowledge_store = None
+retriever = None
+dense_retriever = None
+query_encoder = None
+input_builder = None
+input_builders = {}
+registry = None
+speculative = None
+static_decoder = None
+encoder_cache = None
+# the models the generation workers run on, replicas[0] is `model`
+replicas = []
+reload_lock = Lock()
+# incremented by every hot reload of the main model
+model_revision = 0
+DEFAULT_MODEL = 'default'
 args = dotmap.DotMap()
 args.model_name_or_path = 't5-base'
 args.prompt = ''
@@ -39,30 +83,394 @@ args.seed = 2022
 args.stop_token = '<|endoftext|>'
 args.n_gpu = 1
 args.device = 'cuda:0'
+# CPU serving: int8 dynamic quantization of the Linear layers and the
+# number of intra-op threads (None keeps the torch default)
+args.quantize = False
+args.num_threads = None
+# 'torch', or 'onnx' to serve the graphs written by export_onnx.py (CPU only,
+# args.model_name_or_path is then the export directory)
+args.backend = 'torch'
+# load model.safetensors (memory-mapped) when the checkpoint has one
+args.use_safetensors = True
+# run one generate after loading so the first request does not pay for it;
+# warmup_samples_path is a JSONL file of {"msg", "knowledge", "params"}
+# requests to warm up with instead (also used before a hot reload)
+args.warmup = True
+args.warmup_samples_path = None
+# bearer token of the /admin endpoints (hot reload), disabled when None
+args.admin_token = None
+args.max_batch_size = 16
+args.max_wait_ms = 10
+args.num_workers = 1
+# run tokenization, the model and detokenization of request batches on
+# separate threads connected by queues of pipeline_queue_size batches, so
+# the next batch is tokenized and the previous one detokenized while the
+# model runs (num_workers model threads)
+args.pipeline = False
+args.tokenizer_threads = 1
+args.detokenizer_threads = 1
+args.pipeline_queue_size = 2
+# decode default-model requests (greedy or sampled) in one running batch
+# that sequences join and leave at every step instead of per request batch
+args.continuous_batching = False
+# one model replica per device, workers are spread over them round-robin
+args.worker_devices = []
+# admission control: requests beyond max_queue_size get a 503, requests
+# still queued after their timeout (seconds, overridable per request up to
+# max_request_timeout) are dropped; /generate_stream serves at most
+# max_streams replies at a time, each stopped at its timeout
+args.max_queue_size = 256
+args.request_timeout = 30
+args.max_request_timeout = 300
+args.max_streams = 4
+# order of the generation queue: 'fifo', 'sjf' (cheapest estimated cost
+# first, a request waits at most cost / sjf_cost_per_second seconds behind
+# cheaper ones) or 'priority' (a request's "priority" class is served as if
+# it had arrived priority_delays[class] seconds later)
+args.scheduling = 'fifo'
+args.sjf_cost_per_second = 200
+args.priority_delays = {'interactive': 0, 'batch': 10}
+# /generate_batch: items per padded batch and concurrent bulk requests
+args.bulk_batch_size = 64
+args.max_bulk_jobs = 1
+args.cache_max_bytes = 64 * 2 ** 20
+args.cache_ttl = 600
+args.cache_sampling = False
+# encoder outputs of recent inputs, so regenerating or sampling another
+# candidate for the same input only runs the decoder (0 disables it)
+args.encoder_cache_max_bytes = 256 * 2 ** 20
+# dialog sessions: token ids of every turn kept on the server, evicted
+# least recently used or after session_ttl idle seconds
+args.session_max_bytes = 64 * 2 ** 20
+args.session_ttl = 1800
+args.session_max_turns = None
+# DSTC9-style knowledge.json served by id through `knowledge_ids`
+args.knowledge_path = None
+# DSTC7 grounded facts files (*.facts.txt) added to the knowledge store
+args.facts_paths = []
+# requests without knowledge get the best of retrieval_top_k documents found
+# by a BM25 index over the knowledge store (saved in retrieval_index_dir),
+# as many as fit into max_knowledge_length; the query is the latest
+# retrieval_turns turns
+args.retrieval_index_dir = None
+args.retrieval_top_k = 5
+args.retrieval_turns = 2
+# a dense index written by GODEL/embed_knowledge.py over the same documents,
+# queried with embeddings of dense_model_name_or_path (the model it was built
+# with); fused with the BM25 ranking when both are set
+args.dense_index_dir = None
+args.dense_model_name_or_path = None
+args.dense_nprobe = 8
+# token budgets of the encoder input, oldest turns are dropped first
+args.max_context_length = None
+args.max_knowledge_length = None
+
+# extra fine-tuned checkpoints selected per request by name ({name: path}),
+# loaded on demand and evicted least recently used above max_model_bytes
+args.checkpoints = {}
+args.max_model_bytes = None
+# a smaller GODEL checkpoint with the same tokenizer drafting tokens for
+# greedy requests to the main model
+args.draft_model_name_or_path = None
+args.num_speculative_tokens = 4
+# greedy/beam requests of the main model (T5-style) go through a decode
+# loop with a preallocated KV cache of args.length positions, optionally
+# torch.compile'd with the compiled artifacts kept in compile_cache_dir
+args.static_decoding = False
+args.compile = False
+args.compile_cache_dir = '~/.cache/godel/inductor'
+
+# decoding parameters a request may override
+GEN_PARAMS = ('max_length', 'min_length', 'num_beams', 'do_sample', 'top_k',
+              'top_p', 'temperature', 'repetition_penalty', 'no_repeat_ngram_size')
 
 set_seed(args)
 
+STAGE_SECONDS = metrics.histogram(
+    'godel_stage_seconds', 'Time per generate call spent in each stage', labelnames=('stage',))
+BATCH_SIZE = metrics.histogram(
+    'godel_batch_size', 'Sequences per generate call', buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+INPUT_TOKENS = metrics.counter('godel_input_tokens_total', 'Encoder input tokens, padding excluded')
+OUTPUT_TOKENS = metrics.counter('godel_output_tokens_total', 'Generated tokens, padding excluded')
+TOKENS_PER_SECOND = metrics.histogram(
+    'godel_output_tokens_per_second', 'Generated tokens per second of each generate call',
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+
 
 def main():
-    global model, tokenizer, args
+    global model, tokenizer, knowledge_store, retriever, dense_retriever, query_encoder, input_builder, registry
+    global speculative, static_decoder, encoder_cache, args
+
+    timings = {'import': IMPORT_SECONDS}
+    model = load_model(args.model_name_or_path, timings)
+
+    start = time.perf_counter()
+    tokenizer = load_tokenizer(args.model_name_or_path)
+    input_builder = get_input_builder(tokenizer)
+
+    sources = ([args.knowledge_path] if args.knowledge_path else []) + list(args.facts_paths)
+    if sources:
+        knowledge_store = KnowledgeStore(tokenizer)
+        if args.knowledge_path:
+            knowledge_store.load_dstc9(args.knowledge_path)
+        for path in args.facts_paths:
+            knowledge_store.load_facts(path)
+    timings['tokenizer'] = time.perf_counter() - start
+
+    if args.retrieval_index_dir:
+        start = time.perf_counter()
+        # rebuilt whenever one of the source files changes
+        fingerprint = [[os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)] for path in sources]
+        retriever = BM25Index.load_or_build(os.path.expanduser(args.retrieval_index_dir),
+                                            knowledge_store.docs, fingerprint=fingerprint)
+        timings['retrieval_index'] = time.perf_counter() - start
+
+    if args.dense_index_dir:
+        start = time.perf_counter()
+        dense_retriever = DenseIndex.load(os.path.expanduser(args.dense_index_dir))
+        missing = sum(key not in knowledge_store for key in dense_retriever.keys)
+        if missing:
+            raise ValueError(f'{missing} documents of {args.dense_index_dir} are not in the knowledge store, '
+                             'run GODEL/embed_knowledge.py again')
+        query_encoder = TextEncoder(args.dense_model_name_or_path, device=args.device)
+        timings['dense_index'] = time.perf_counter() - start
+
+    if args.draft_model_name_or_path:
+        start = time.perf_counter()
+        if vocab_fingerprint(load_tokenizer(args.draft_model_name_or_path)) != vocab_fingerprint(tokenizer):
+            raise ValueError('The draft model must use the same tokenizer as the main model')
+        speculative = SpeculativeDecoder(model, load_model(args.draft_model_name_or_path),
+                                         num_speculative_tokens=args.num_speculative_tokens)
+        timings['draft'] = time.perf_counter() - start
+
+    if args.static_decoding:
+        start = time.perf_counter()
+        from GODEL.utils.static_decoding import StaticT5Decoder, enable_compile_cache
+        if args.compile:
+            enable_compile_cache(args.compile_cache_dir)
+        static_decoder = StaticT5Decoder(model, max_length=args.length, compile=args.compile)
+        timings['static_decoding'] = time.perf_counter() - start
 
-    config = AutoConfig.from_pretrained(args.model_name_or_path)
-    model = AutoModelForSeq2SeqLM.from_pretrained(
-        args.model_name_or_path,
-        from_tf=bool(".ckpt" in args.model_name_or_path),
-        config=config,
-    )
+    if args.encoder_cache_max_bytes:
+        encoder_cache = EncoderCache(args.encoder_cache_max_bytes)
+
+    registry = ModelRegistry(load_model, load_tokenizer, max_bytes=args.max_model_bytes)
+    registry.pin(DEFAULT_MODEL, model, tokenizer)
+    for name, path in args.checkpoints.items():
+        registry.add(name, path)
+
+    if args.warmup:
+        start = time.perf_counter()
+        warm_up([model])
+        timings['warmup'] = time.perf_counter() - start
+
+    logger.info('Startup time (s): ' + ', '.join(f'{stage} {seconds:.2f}' for stage, seconds in timings.items()))
+
+
+def load_model(path, timings=None):
+    global args
+
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    if args.backend == 'onnx':
+        from GODEL.utils.onnx_backend import OnnxSeq2Seq
+        model = OnnxSeq2Seq(path, num_threads=args.num_threads)
+        timings['weights'] = time.perf_counter() - start
+        return model
+
+    config = AutoConfig.from_pretrained(path)
+    timings['config'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if args.use_safetensors and has_safetensors(path):
+        model = load_safetensors(path, config, device=args.device)
+    else:
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            path,
+            from_tf=bool(".ckpt" in path),
+            config=config,
+        )
 
     model = model.to(args.device)
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.model_name_or_path, use_fast=not args.use_slow_tokenizer)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    if args.quantize:
+        model = quantize_dynamic(model)
+    timings['weights'] = time.perf_counter() - start
+    return model
+
+
+def load_tokenizer(path):
+    global args
+
+    return AutoTokenizer.from_pretrained(path, use_fast=not args.use_slow_tokenizer)
+
+
+def get_input_builder(tokenizer):
+    global args
+
+    if id(tokenizer) not in input_builders:
+        input_builders[id(tokenizer)] = InputBuilder(
+            tokenizer,
+            max_context_length=args.max_context_length,
+            max_knowledge_length=args.max_knowledge_length,
+        )
+    return input_builders[id(tokenizer)]
+
+
+def get_model(name=None):
+    """
+    The (model, tokenizer, input builder) serving the checkpoint `name`
+    from `args.checkpoints`, the main model when `name` is None.
+    """
+    global model, tokenizer, input_builder, registry
+
+    if name is None or name == DEFAULT_MODEL:
+        return model, tokenizer, input_builder
+    named_model, named_tokenizer = registry.get(name)
+    return named_model, named_tokenizer, get_input_builder(named_tokenizer)
+
+
+def quantize_dynamic(model):
+    """
+    int8 dynamic quantization of every nn.Linear (weights stored in int8,
+    activations quantized on the fly). Only supported on CPU.
+    """
+    if model.device.type != 'cpu':
+        raise ValueError("Dynamic quantization is only supported on CPU, set args.device = 'cpu'")
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def replicate(base):
+    """
+    `base` plus a copy of it for every extra device listed in
+    `args.worker_devices`.
+    """
+    global args
+
+    copies = [base]
+    for device in args.worker_devices:
+        if torch.device(device) != torch.device(args.device):
+            copies.append(copy.deepcopy(base).to(device))
+    return copies
+
+
+def load_replicas():
+    """
+    Return the models the generation workers run on: the main model plus a
+    copy for every extra device listed in `args.worker_devices`.
+    """
+    global model, replicas
+
+    replicas = replicate(model)
+    return replicas
+
+
+def get_replica(worker=None):
+    """
+    The replica generation worker number `worker` runs on. Workers look it
+    up for every batch, so a hot reload takes effect from their next batch.
+    """
+    global model, replicas
+
+    current = replicas or [model]
+    return current[0] if worker is None else current[worker % len(current)]
+
+
+def warmup_samples():
+    """
+    (context, knowledge, params) of the warm-up requests.
+    """
+    global args
+
+    if not args.warmup_samples_path:
+        return [('warm up', '', None)]
+    samples = []
+    with open(args.warmup_samples_path) as f:
+        for line in f:
+            if line.strip():
+                sample = json.loads(line)
+                samples.append((' EOS '.join(sample['msg']), sample.get('knowledge') or '', sample.get('params')))
+    return samples
+
+
+def warm_up(models, decoders=None):
+    """
+    Generate the warm-up requests on each of `models` (through the given
+    speculative and static decoders when they support a request).
+    """
+    for context, knowledge, params in warmup_samples():
+        encodings = pad_inputs(encode_batch([context], [knowledge]))
+        for replica in models:
+            run_generation(encodings, params=params, replica=replica, decoders=decoders)
+
+
+def reload_model(path):
+    """
+    Load the checkpoint `path`, warm it up and swap it in as the main model.
+    Batches already running finish on the old weights, the next ones run on
+    the new weights. The checkpoint must use the current tokenizer, which
+    the knowledge store and queued requests are already encoded with.
+
+    Returns the timings of the reload and a weak reference to the old model.
+    """
+    global model, tokenizer, registry, speculative, static_decoder, encoder_cache, replicas, model_revision, args
+
+    with reload_lock:
+        timings = {}
+        if vocab_fingerprint(load_tokenizer(path)) != vocab_fingerprint(tokenizer):
+            raise ValueError(f'{path} does not use the tokenizer of the running model')
+        new_model = load_model(path, timings)
+
+        start = time.perf_counter()
+        new_speculative = new_static_decoder = None
+        if speculative is not None:
+            new_speculative = SpeculativeDecoder(new_model, speculative.draft_model,
+                                                 num_speculative_tokens=args.num_speculative_tokens)
+        if static_decoder is not None:
+            from GODEL.utils.static_decoding import StaticT5Decoder
+            new_static_decoder = StaticT5Decoder(new_model, max_length=args.length, compile=args.compile)
+        new_replicas = replicate(new_model)
+        timings['replicas'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        warm_up(new_replicas, decoders=(new_speculative, new_static_decoder))
+        timings['warmup'] = time.perf_counter() - start
 
+        old_model = weakref.ref(model)
+        model, speculative, static_decoder, replicas = new_model, new_speculative, new_static_decoder, new_replicas
+        model_revision += 1
+        registry.pin(DEFAULT_MODEL, model, tokenizer)
+        args.model_name_or_path = path
+        if encoder_cache is not None:
+            # entries of the old model would only wait for eviction
+            encoder_cache.clear()
+        logger.info(f'Reloaded {path} (s): ' + ', '.join(f'{stage} {seconds:.2f}' for stage, seconds in timings.items()))
+        return timings, old_model
 
-def generate(context, knowledge):
-    global model, args, tokenizer
 
-    input_ids = tokenizer(context + ' <|knowledge|> ' + knowledge +
-                          ' =>', return_tensors="pt").input_ids.to(args.device)
+def free_model(model_ref, timeout=60):
+    """
+    Wait up to `timeout` seconds for the in-flight batches holding the model
+    behind the weak reference `model_ref` to let go of it, then return its
+    cached device memory. Returns whether the model was freed.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        gc.collect()
+        if model_ref() is None:
+            break
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.1)
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return True
+
+
+def get_gen_kwargs(params=None):
+    global args
+
     gen_kwargs = {
         # 'num_beams': args.num_beams,
         'max_length': args.length,
@@ -71,13 +479,320 @@ def generate(context, knowledge):
         'no_repeat_ngram_size': 4
 
     }
+    for key, value in (params or {}).items():
+        if key in GEN_PARAMS:
+            gen_kwargs[key] = value
+    return gen_kwargs
+
+
+def invalid_params(params=None):
+    """
+    Why the decoding `params` of a request are malformed, None when they
+    are not. Unknown keys are ignored like in `get_gen_kwargs`.
+    """
+    for key in ('max_length', 'num_beams'):
+        value = (params or {}).get(key, 1)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            return f'"{key}" must be a positive integer'
+    for key in ('min_length', 'top_k', 'no_repeat_ngram_size'):
+        value = (params or {}).get(key, 0)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            return f'"{key}" must be a non-negative integer'
+    for key in ('temperature', 'repetition_penalty', 'top_p'):
+        value = (params or {}).get(key, 1.0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 < value < float('inf'):
+            return f'"{key}" must be a positive number'
+    if (params or {}).get('top_p', 1.0) > 1:
+        return '"top_p" must be at most 1'
+    if not isinstance((params or {}).get('do_sample', False), bool):
+        return '"do_sample" must be a boolean'
+    gen_kwargs = get_gen_kwargs(params)
+    if gen_kwargs['min_length'] > gen_kwargs['max_length']:
+        return f'"min_length" ({gen_kwargs["min_length"]}) must not exceed "max_length" ({gen_kwargs["max_length"]})'
+    return None
+
+
+def unsupported_params(params=None):
+    """
+    Why the serving backend cannot decode with `params`, None when it can.
+    The onnx backend only implements greedy decoding without a repetition
+    penalty.
+    """
+    global args
+
+    if args.backend != 'onnx':
+        return None
+    gen_kwargs = get_gen_kwargs(params)
+    if gen_kwargs.get('num_beams', 1) > 1 or gen_kwargs.get('do_sample', False):
+        return 'the onnx backend only supports greedy decoding'
+    if gen_kwargs.get('repetition_penalty', 1.0) != 1.0:
+        return 'the onnx backend does not support repetition_penalty'
+    return None
+
+
+def generate(context, knowledge=None, params=None):
+    return generate_batch([context], [knowledge], params=params)
+
+
+def encode_batch(contexts, knowledges, builder=None):
+    global input_builder
+    builder = input_builder if builder is None else builder
+
+    return [builder.build(context.split(' EOS '), knowledge)
+            for context, knowledge in zip(contexts, knowledges)]
+
+
+def encode_with_knowledge_ids(context, knowledge_ids, builder=None, turn_ids=None):
+    """
+    Same ids as `encode_batch` gives for the text of the documents
+    `knowledge_ids` in the knowledge store, but only the context is
+    tokenized per request (nothing is when the context comes as `turn_ids`).
+    """
+    global input_builder, knowledge_store
+    builder = input_builder if builder is None else builder
+    turns = context.split(' EOS ') if turn_ids is None else None
+
+    if builder.tokenizer is not knowledge_store.tokenizer:
+        # the cached ids belong to another vocabulary
+        return builder.build(turns, knowledge_store.text(knowledge_ids), turn_ids=turn_ids)
+    return builder.build(turns, turn_ids=turn_ids, knowledge_ids=knowledge_store.get_ids(knowledge_ids))
+
+
+def has_retrieval():
+    return retriever is not None or dense_retriever is not None
+
+
+def fit_knowledge_budget(keys):
+    """
+    The documents of `keys`, in order, that fit into the knowledge budget
+    (at least the first one, which is then cut).
+    """
+    if args.max_knowledge_length is None:
+        return keys
+    selected, length = [], 0
+    for key in keys:
+        key_length = len(knowledge_store.token_ids(key))
+        if length + key_length <= args.max_knowledge_length:
+            selected.append(key)
+            length += key_length
+    return selected or keys[:1]
+
+
+def retrieve_knowledge_batch(turn_lists):
+    """
+    For each dialog of `turn_lists`, the keys of the documents best matching
+    its latest turns, best first and fitted into the knowledge budget. The
+    dense queries of all dialogs are embedded and scored together.
+    """
+    global retriever, dense_retriever, query_encoder
+    queries = [' '.join(turns[-args.retrieval_turns:]) for turns in turn_lists]
+    with STAGE_SECONDS.time(stage='retrieve'):
+        rankings = [[] for _ in queries]
+        if retriever is not None:
+            for ranking, query in zip(rankings, queries):
+                ranking.append(retriever.search(query, k=args.retrieval_top_k))
+        if dense_retriever is not None:
+            found = dense_retriever.search(query_encoder.encode(queries), k=args.retrieval_top_k,
+                                           nprobe=args.dense_nprobe)
+            for ranking, keys in zip(rankings, found):
+                ranking.append(keys)
+        return [fit_knowledge_budget(fuse_rankings(ranking)[:args.retrieval_top_k]) for ranking in rankings]
+
+
+def retrieve_knowledge(turns):
+    return retrieve_knowledge_batch([turns])[0]
+
+
+def generate_batch(contexts, knowledges, params=None, replica=None):
+    # a knowledge of None is retrieved from the knowledge store
+    missing = [i for i, knowledge in enumerate(knowledges) if knowledge is None]
+    if missing and has_retrieval():
+        knowledges = list(knowledges)
+        retrieved = retrieve_knowledge_batch([contexts[i].split(' EOS ') for i in missing])
+        for i, keys in zip(missing, retrieved):
+            knowledges[i] = knowledge_store.text(keys)
+    with STAGE_SECONDS.time(stage='tokenize'):
+        input_ids = encode_batch(contexts, knowledges)
+    return generate_ids(input_ids, params=params, replica=replica)
+
 
-    output_sequences = model.generate(input_ids, **gen_kwargs)
-    output_sequences = tokenizer.batch_decode(
-        output_sequences, skip_special_tokens=True)
+def synchronize(device):
+    # CUDA kernels run asynchronously, wait for them so stage timings are real
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class StopWhen(StoppingCriteria):
+    """
+    End generation early once `stop()` is true, e.g. when every caller of
+    the batch has given up.
+    """
+
+    def __init__(self, stop):
+        self.stop = stop
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.stop()
+
+
+def use_tensorized_processors(gen_kwargs, config):
+    """
+    Have `generate()` block repeated n-grams and early eos with the
+    tensorized processors instead of its own, which loop over every
+    hypothesis in Python.
+    """
+    if gen_kwargs.get('min_length', 0) > gen_kwargs.get('max_length', float('inf')):
+        # `generate()` only checks this when it builds its own min length processor
+        raise ValueError(f'Unfeasible length constraints: the minimum length ({gen_kwargs["min_length"]}) '
+                         f'is larger than the maximum length ({gen_kwargs["max_length"]})')
+    processors = LogitsProcessorList()
+    if gen_kwargs.get('no_repeat_ngram_size'):
+        processors.append(NoRepeatNGramProcessor(gen_kwargs['no_repeat_ngram_size']))
+    if gen_kwargs.get('min_length'):
+        processors.append(MinLengthProcessor(gen_kwargs['min_length'], config.eos_token_id))
+    gen_kwargs.update(no_repeat_ngram_size=0, min_length=0, logits_processor=processors)
+
+
+def pad_inputs(input_ids, replica_tokenizer=None):
+    """
+    Pad a batch of token id lists into CPU tensors, the CPU half of
+    preparing a generate call.
+    """
+    replica_tokenizer = tokenizer if replica_tokenizer is None else replica_tokenizer
+    return replica_tokenizer.pad({'input_ids': input_ids}, return_tensors="pt")
+
+
+def pick_decoder(replica, gen_kwargs, decoders=None):
+    """
+    The speculative or static decoder (`decoders`, the server's by default)
+    wrapping `replica` if it supports `gen_kwargs`, else `replica` itself.
+    """
+    global speculative, static_decoder
+
+    spec, static = (speculative, static_decoder) if decoders is None else decoders
+    if spec is not None and spec.model is replica and spec.supports(gen_kwargs):
+        return spec
+    if static is not None and static.model is replica and static.supports(gen_kwargs):
+        return static
+    return replica
+
+
+def run_generation(encodings, params=None, replica=None, stop=None, decoders=None):
+    """
+    Generate for the padded `encodings` on `replica`, returning the output
+    ids on the CPU and the decoding time in seconds.
+    """
+    global model, args, encoder_cache
+    replica = model if replica is None else replica
+    device = replica.device
+
+    input_ids = encodings.input_ids.to(device)
+    attention_mask = encodings.attention_mask.to(device)
+    gen_kwargs = get_gen_kwargs(params)
+    replica = pick_decoder(replica, gen_kwargs, decoders)
+
+    start = time.perf_counter()
+    if isinstance(replica, torch.nn.Module):
+        if stop is not None:
+            gen_kwargs['stopping_criteria'] = StoppingCriteriaList([StopWhen(stop)])
+        use_tensorized_processors(gen_kwargs, replica.config)
+        # run the encoder separately so its time is not counted as decoding
+        if encoder_cache is not None:
+            gen_kwargs['encoder_outputs'] = encoder_cache.encode(replica, input_ids, attention_mask)
+        else:
+            with torch.no_grad():
+                gen_kwargs['encoder_outputs'] = replica.get_encoder()(
+                    input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+        synchronize(device)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage='encode')
+        start = time.perf_counter()
+    # the onnx, speculative and static backends run their encoder inside generate
+    output_sequences = replica.generate(
+        input_ids, attention_mask=attention_mask, **gen_kwargs)
+    synchronize(device)
+    decode_seconds = time.perf_counter() - start
+    STAGE_SECONDS.observe(decode_seconds, stage='decode_loop')
+    return output_sequences.cpu(), decode_seconds
+
+
+def decode_outputs(output_sequences, encodings, decode_seconds, replica_tokenizer=None):
+    """
+    Detokenize the output ids of `run_generation` and record the token
+    metrics of the call.
+    """
+    replica_tokenizer = tokenizer if replica_tokenizer is None else replica_tokenizer
+    with STAGE_SECONDS.time(stage='detokenize'):
+        num_output_tokens = int((output_sequences[:, 1:] != replica_tokenizer.pad_token_id).sum())
+        output_sequences = replica_tokenizer.batch_decode(
+            output_sequences, skip_special_tokens=True)
+
+    BATCH_SIZE.observe(len(output_sequences))
+    INPUT_TOKENS.inc(int(encodings.attention_mask.sum()))
+    OUTPUT_TOKENS.inc(num_output_tokens)
+    if decode_seconds > 0:
+        TOKENS_PER_SECOND.observe(num_output_tokens / decode_seconds)
 
     return output_sequences
 
 
+def generate_ids(input_ids, params=None, replica=None, replica_tokenizer=None, stop=None):
+    encodings = pad_inputs(input_ids, replica_tokenizer)
+    output_sequences, decode_seconds = run_generation(encodings, params=params, replica=replica, stop=stop)
+    return decode_outputs(output_sequences, encodings, decode_seconds, replica_tokenizer)
+
+
+def generate_stream(context, knowledge, stop=None):
+    """
+    Greedy step-wise decoding with the same settings as `generate`, yielding
+    each new piece of text as soon as its token is decoded. Decoding ends
+    early once `stop()` is true.
+    """
+    global args, tokenizer
+
+    # the whole reply is decoded by the model current at its start
+    replica = get_replica()
+    if not isinstance(replica, torch.nn.Module):
+        raise ValueError('Streaming needs a torch model, the onnx backend does not support it')
+    input_ids = torch.tensor(encode_batch([context], [knowledge]), device=args.device)
+    logits_processor = LogitsProcessorList([
+        MinLengthProcessor(32, replica.config.eos_token_id),
+        NoRepeatNGramProcessor(4),
+    ])
+
+    with torch.no_grad():
+        encoder_outputs = replica.get_encoder()(input_ids=input_ids, return_dict=True)
+        decoder_input_ids = torch.full(
+            (1, 1), replica.config.decoder_start_token_id, dtype=torch.long, device=args.device)
+        past_key_values = None
+        text = ''
+        while decoder_input_ids.shape[-1] < args.length:
+            if stop is not None and stop():
+                break
+            outputs = replica(
+                encoder_outputs=encoder_outputs,
+                decoder_input_ids=decoder_input_ids[:, -1:],
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+            past_key_values = outputs.past_key_values
+            scores = logits_processor(decoder_input_ids, outputs.logits[:, -1, :])
+            next_token = torch.argmax(scores, dim=-1)
+            decoder_input_ids = torch.cat([decoder_input_ids, next_token[:, None]], dim=-1)
+            if next_token.item() == replica.config.eos_token_id:
+                break
+
+            # sentencepiece may rewrite the tail of the text once the next
+            # piece arrives, so only emit text that extends what was sent
+            new_text = tokenizer.decode(decoder_input_ids[0], skip_special_tokens=True)
+            if new_text.startswith(text) and len(new_text) > len(text):
+                yield new_text[len(text):]
+                text = new_text
+
+        new_text = tokenizer.decode(decoder_input_ids[0], skip_special_tokens=True)
+        if new_text != text and new_text.startswith(text):
+            yield new_text[len(text):]
+
+
 if __name__ == '__main__':
     main()
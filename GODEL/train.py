@@ -37,6 +37,7 @@ from transformers import (
     set_seed,
 )
 
+from utils.input_builder import InputBuilder
 from utils.text_normalization import normalize_answer
 from dotenv import load_dotenv
 
@@ -213,6 +214,16 @@ def parse_args():
     parser.add_argument(
         "--max_length", type=int, default=128, help="max length"
     )
+    parser.add_argument(
+        "--max_context_length",
+        type=int,
+        default=None,
+        help="Token budget of the dialog context. Oldest turns are dropped first, so the markers and recent "
+        "turns are kept. The built input is still cut from the right to --max_length.",
+    )
+    parser.add_argument(
+        "--max_knowledge_length", type=int, default=None, help="Token budget of the knowledge, cut from the right."
+    )
     parser.add_argument(
         "--pad_to_max_length", type=bool, default=True, help="do pading"
     )
@@ -381,6 +392,15 @@ def main():
 
     padding = "max_length" if args.pad_to_max_length else False
     max_target_length = args.max_target_length
+    input_builder = InputBuilder(
+        tokenizer,
+        knowledge_marker=' <|Knowledge|> ',
+        end_marker=' => ',
+        max_context_length=args.max_context_length,
+        max_knowledge_length=args.max_knowledge_length,
+        # a part without a budget is still bounded by --max_length
+        max_length=args.max_length,
+    )
     def dataset_mapping_function(examples):
         contextes = examples['Context']
         responses = examples['Response']
@@ -393,7 +413,14 @@ def main():
             else:
                 _input = context + ' <|Knowledge|> ' + kb + ' => '
                 inputs.append(_input)
-        model_inputs = tokenizer(inputs, max_length=args.max_length, padding=padding, truncation=True)
+        if args.max_context_length is not None or args.max_knowledge_length is not None:
+            input_ids = [
+                input_builder.build(context.split(' EOS '), kb, use_knowledge=not args.no_kb)
+                for context, kb in zip(contextes, kbs)
+            ]
+            model_inputs = tokenizer.pad({'input_ids': input_ids}, max_length=args.max_length, padding=padding)
+        else:
+            model_inputs = tokenizer(inputs, max_length=args.max_length, padding=padding, truncation=True)
 
         # Setup the tokenizer for targets
         with tokenizer.as_target_tokenizer():
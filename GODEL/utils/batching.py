@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Dynamic micro-batching for the generation server
+"""
+
+import time
+from concurrent.futures import Future
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+from GODEL.utils.metrics import metrics
+
+
+DROPPED = metrics.counter('godel_dropped_total', 'Requests dropped instead of generated', labelnames=('reason',))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class MicroBatcher(object):
+    """
+    Pull pending requests off a queue and run them through `batch_fn`
+    together. A batch is closed once it holds `max_batch_size` items or
+    `max_wait_ms` milliseconds have passed since its first item arrived.
+
+    With a bounded queue `submit` raises `queue.Full` instead of letting
+    the backlog grow. Requests whose deadline has passed or that were
+    cancelled are dropped when their batch is formed, and `batch_fn` gets a
+    `stop` callable telling it when every request of the running batch has
+    been abandoned.
+    """
+
+    def __init__(self, in_queue, batch_fn, max_batch_size=16, max_wait_ms=10):
+        self.in_queue = in_queue
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        # request id -> Future, so every worker can hand results back to
+        # the exact caller that submitted them
+        self.pending = {}
+        self.abandoned = set()
+        self.lock = Lock()
+
+    def submit(self, request_id, payload, deadline=None):
+        """
+        `deadline` is a `time.monotonic()` timestamp after which the result
+        is no longer wanted.
+        """
+        future = Future()
+        with self.lock:
+            self.pending[request_id] = future
+        try:
+            self.in_queue.put_nowait((request_id, payload, deadline))
+        except Exception as e:
+            # e.g. Full, or a scheduling policy failing on the payload:
+            # the request never got queued, so nothing would resolve it
+            self.resolve(request_id)
+            future.set_exception(e)
+            if isinstance(e, Full):
+                DROPPED.inc(reason='queue_full')
+            raise
+        return future
+
+    def cancel(self, request_id):
+        """
+        The caller stopped waiting: a queued request is dropped, a running
+        one is marked so its batch can stop early.
+        """
+        with self.lock:
+            future = self.pending.get(request_id)
+            if future is None:
+                return
+            self.abandoned.add(request_id)
+        future.cancel()
+
+    def is_abandoned(self, request_id, deadline, now=None):
+        if deadline is not None and deadline <= (now or time.monotonic()):
+            return True
+        with self.lock:
+            return request_id in self.abandoned
+
+    def collect(self):
+        batch = [self.in_queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.in_queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def resolve(self, request_id):
+        with self.lock:
+            self.abandoned.discard(request_id)
+            return self.pending.pop(request_id)
+
+    def admit(self, batch):
+        """
+        Drop the cancelled and expired requests of `batch`, return the rest
+        with their futures marked as running.
+        """
+        admitted = []
+        now = time.monotonic()
+        for request_id, payload, deadline in batch:
+            with self.lock:
+                # stays in `pending` while it runs so cancel() can reach it
+                future = self.pending[request_id]
+            if not future.set_running_or_notify_cancel():
+                self.resolve(request_id)
+                DROPPED.inc(reason='cancelled')
+            elif self.is_abandoned(request_id, deadline, now):
+                self.resolve(request_id)
+                future.set_exception(DeadlineExceeded())
+                DROPPED.inc(reason='expired')
+            else:
+                admitted.append((request_id, payload, deadline, future))
+        return admitted
+
+    def stopper(self, admitted):
+        """
+        A callable telling whether every request of `admitted` has been
+        abandoned.
+        """
+        def stop():
+            now = time.monotonic()
+            return all(self.is_abandoned(request_id, deadline, now)
+                       for request_id, _, deadline, _ in admitted)
+        return stop
+
+    def complete(self, batch, admitted, results=None, error=None):
+        """
+        Hand the `results` (or `error`) of the `admitted` requests to their
+        callers and mark every item of `batch` as done. A result that is an
+        exception fails only its own request.
+        """
+        try:
+            for i, (_, _, _, future) in enumerate(admitted):
+                if error is not None:
+                    future.set_exception(error)
+                elif isinstance(results[i], Exception):
+                    future.set_exception(results[i])
+                else:
+                    future.set_result(results[i])
+        finally:
+            for request_id, _, _, _ in admitted:
+                self.resolve(request_id)
+            for _ in batch:
+                self.in_queue.task_done()
+
+    def run(self, batch_fn=None):
+        batch_fn = batch_fn or self.batch_fn
+        while True:
+            batch = self.collect()
+            admitted = self.admit(batch)
+            results = error = None
+            try:
+                if admitted:
+                    results = batch_fn([payload for _, payload, _, _ in admitted], stop=self.stopper(admitted))
+            except Exception as e:
+                error = e
+            self.complete(batch, admitted, results, error)
+
+    def start(self, batch_fns=None):
+        """
+        Start one daemon worker per entry of `batch_fns` (e.g. one per model
+        replica), all draining the same queue.
+        """
+        workers = []
+        for batch_fn in batch_fns or [self.batch_fn]:
+            worker = Thread(target=self.run, args=(batch_fn,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return workers
+
+
+class PipelinedBatcher(MicroBatcher):
+    """
+    MicroBatcher running every batch through three stages on their own
+    threads: `prepare_fn(payloads)` (e.g. tokenization) on
+    `num_prepare_threads` threads, `execute_fn(job, stop=stop)` (the model)
+    on one thread per executor, and `finish_fn(job)` (e.g. detokenization,
+    returning one result per payload) on `num_finish_threads` threads.
+
+    The stages are connected by queues holding at most `queue_size`
+    batches, so the next batch is prepared and the previous one finished
+    while the model runs. When the model falls behind, the prepare threads
+    block and new requests wait in the request queue, where they are
+    batched together instead of in many small batches.
+    """
+
+    def __init__(self, in_queue, prepare_fn, execute_fn, finish_fn, max_batch_size=16, max_wait_ms=10,
+                 queue_size=2, num_prepare_threads=1, num_finish_threads=1):
+        super().__init__(in_queue, execute_fn, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        self.prepare_fn = prepare_fn
+        self.finish_fn = finish_fn
+        self.num_prepare_threads = num_prepare_threads
+        self.num_finish_threads = num_finish_threads
+        self.prepared = Queue(queue_size)
+        self.executed = Queue(queue_size)
+
+    def prepare_loop(self):
+        while True:
+            batch = self.collect()
+            admitted = self.admit(batch)
+            if not admitted:
+                self.complete(batch, admitted)
+                continue
+            try:
+                job = self.prepare_fn([payload for _, payload, _, _ in admitted])
+            except Exception as e:
+                self.complete(batch, admitted, error=e)
+                continue
+            self.prepared.put((batch, admitted, job))
+
+    def execute_loop(self, execute_fn):
+        while True:
+            batch, admitted, job = self.prepared.get()
+            stop = self.stopper(admitted)
+            try:
+                # every caller may have given up while the batch was queued
+                if stop():
+                    raise DeadlineExceeded()
+                job = execute_fn(job, stop=stop)
+            except Exception as e:
+                self.complete(batch, admitted, error=e)
+                continue
+            self.executed.put((batch, admitted, job))
+
+    def finish_loop(self):
+        while True:
+            batch, admitted, job = self.executed.get()
+            results = error = None
+            try:
+                results = self.finish_fn(job)
+            except Exception as e:
+                error = e
+            self.complete(batch, admitted, results, error)
+
+    def stats(self):
+        return {'prepared': self.prepared.qsize(), 'executed': self.executed.qsize()}
+
+    def start(self, execute_fns=None):
+        """
+        Start the prepare and finish threads and one executor thread per
+        entry of `execute_fns` (e.g. one per model replica).
+        """
+        targets = [(self.prepare_loop, ())] * self.num_prepare_threads
+        targets += [(self.execute_loop, (execute_fn,)) for execute_fn in execute_fns or [self.batch_fn]]
+        targets += [(self.finish_loop, ())] * self.num_finish_threads
+        workers = []
+        for target, args in targets:
+            worker = Thread(target=target, args=args)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return workers
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+In-process caches used by the generation server
+"""
+
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache bounded by the total size of its values in bytes,
+    with an optional time-to-live in seconds.
+    """
+
+    def __init__(self, max_bytes, ttl=None, sizeof=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: len(json.dumps(value).encode('utf-8')))
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += count
+                return None
+            self.entries.move_to_end(key)
+            self.hits += count
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expires)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.entries:
+                return self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        value, size, _ = self.entries.pop(key)
+        self.nbytes -= size
+        return value
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class ResponseCache(object):
+    """
+    Cache of generated responses keyed by (normalized context, knowledge,
+    decoding params). Concurrent identical requests are coalesced onto a
+    single generation. Sampled outputs are only cached when
+    `cache_sampling` is set, since callers expect them to differ.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, ttl=600, cache_sampling=False):
+        self.cache = LRUCache(max_bytes, ttl=ttl)
+        self.cache_sampling = cache_sampling
+        self.in_flight = {}
+        self.coalesced = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def key(context, knowledge, params=None, knowledge_ids=None):
+        context = ' '.join(context.split())
+        knowledge = ' '.join(knowledge.split())
+        return json.dumps([context, knowledge, knowledge_ids or [], params or {}], sort_keys=True)
+
+    def is_cacheable(self, params=None):
+        return self.cache_sampling or not (params or {}).get('do_sample', False)
+
+    def get_or_compute(self, key, compute, timeout=None):
+        """
+        `timeout` bounds how long a coalesced caller waits for the request
+        it was attached to.
+        """
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result(timeout=timeout)
+
+        try:
+            value = compute()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            self.cache.put(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['coalesced'] = self.coalesced
+        return stats
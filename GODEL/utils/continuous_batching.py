@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Iteration-level (continuous) batching for encoder-decoder generation
+"""
+
+import time
+from concurrent.futures import Future
+from queue import Empty
+from threading import Lock, Thread
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.modeling_outputs import BaseModelOutput
+
+from GODEL.utils.batching import DeadlineExceeded
+from GODEL.utils.logits_processors import MinLengthProcessor, repeated_ngram_bans
+from GODEL.utils.scheduling import SchedulingQueue
+
+
+def pad_to(tensor, dim, length, left=False):
+    """
+    Zero-pad `tensor` along `dim` up to `length`, on the left or the right.
+    """
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    padding = tensor.new_zeros(shape)
+    return torch.cat([padding, tensor] if left else [tensor, padding], dim=dim)
+
+
+class Sequence(object):
+    """
+    One request in the engine: its encoder input, decoding settings, the
+    tokens decoded so far and the future its text is delivered through.
+    """
+
+    def __init__(self, input_ids, gen_kwargs, future, deadline, config, priority_class=None):
+        self.input_ids = input_ids
+        self.future = future
+        self.deadline = deadline
+        self.priority_class = priority_class
+        self.eos_token_id = config.eos_token_id
+        self.tokens = [config.decoder_start_token_id]
+        self.max_length = gen_kwargs.get('max_length') or config.max_length
+        self.do_sample = gen_kwargs.get('do_sample', False)
+        # applied to the whole running batch at once by the engine
+        self.ngram_size = gen_kwargs.get('no_repeat_ngram_size') or 0
+        self.min_length = gen_kwargs.get('min_length') or 0
+
+        self.processors = LogitsProcessorList()
+        if gen_kwargs.get('repetition_penalty', 1.0) != 1.0:
+            self.processors.append(RepetitionPenaltyLogitsProcessor(gen_kwargs['repetition_penalty']))
+        if self.do_sample:
+            if gen_kwargs.get('temperature', 1.0) != 1.0:
+                self.processors.append(TemperatureLogitsWarper(gen_kwargs['temperature']))
+            if gen_kwargs.get('top_k'):
+                self.processors.append(TopKLogitsWarper(gen_kwargs['top_k']))
+            if gen_kwargs.get('top_p', 1.0) < 1.0:
+                self.processors.append(TopPLogitsWarper(gen_kwargs['top_p']))
+
+    def next_token(self, scores):
+        if self.processors:
+            prefix = torch.tensor([self.tokens], device=scores.device)
+            scores = self.processors(prefix, scores[None, :])
+        if self.do_sample:
+            return int(torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1))
+        return int(scores.argmax(-1))
+
+    @property
+    def finished(self):
+        return self.tokens[-1] == self.eos_token_id or len(self.tokens) >= self.max_length
+
+
+class ContinuousBatchingEngine(object):
+    """
+    Decode many requests in one running batch that is re-formed at every
+    decoder step: finished sequences leave right away and queued ones take
+    their slots, so a long reply never holds short ones back.
+
+    Each row keeps its own encoder output and key/value caches. Encoder
+    outputs and cross-attention caches are right-padded to the longest
+    input of the batch and masked. Self-attention caches are left-padded to
+    the longest decoded prefix and masked through `decoder_attention_mask`;
+    T5 only uses relative positions, so the padding does not change a row's
+    attention bias. Joining requests are encoded and run through their
+    first decoder step together before they are merged into the batch.
+
+    Greedy decoding and sampling are supported, beam search is not.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=16, max_queue_size=0, policy=None):
+        if not isinstance(model, torch.nn.Module):
+            raise ValueError('Continuous batching needs a torch model')
+        self.model = model
+        self.tokenizer = tokenizer
+        self.config = model.config
+        self.max_batch_size = max_batch_size
+        # `policy` orders the Sequences waiting for a slot
+        self.queue = SchedulingQueue(maxsize=max_queue_size, policy=policy)
+        self.running = []
+        self.state = None
+        self.abandoned = set()
+        self.lock = Lock()
+        self.steps = 0
+        self.next_model = None
+
+    @staticmethod
+    def supports(gen_kwargs):
+        return gen_kwargs.get('num_beams', 1) == 1
+
+    def submit(self, input_ids, gen_kwargs=None, deadline=None, priority_class=None):
+        """
+        Queue the encoder input `input_ids` (a list of ids) and return a
+        future for its decoded text. Raises `queue.Full` when the queue is
+        bounded and full.
+        """
+        future = Future()
+        sequence = Sequence(input_ids, gen_kwargs or {}, future, deadline, self.config, priority_class)
+        self.queue.put_nowait(sequence)
+        return future
+
+    def cancel(self, future):
+        if not future.cancel():
+            with self.lock:
+                self.abandoned.add(future)
+
+    def is_abandoned(self, sequence, now):
+        if sequence.deadline is not None and sequence.deadline <= now:
+            return True
+        with self.lock:
+            return sequence.future in self.abandoned
+
+    def stats(self):
+        return {'running': len(self.running), 'queued': self.queue.qsize(), 'steps': self.steps}
+
+    def swap_model(self, model):
+        """
+        Decode with `model` (same config and tokenizer) once the running
+        sequences have finished on the current one. No sequence joins in
+        the meantime.
+        """
+        with self.lock:
+            self.next_model = model
+
+    def admit(self):
+        if self.next_model is not None:
+            if self.running:
+                return
+            with self.lock:
+                self.model, self.next_model = self.next_model, None
+        joining = []
+        while len(self.running) + len(joining) < self.max_batch_size:
+            try:
+                # wait for work only when nothing is running, waking up now
+                # and then to pick up a swapped model
+                block = not self.running and not joining
+                sequence = self.queue.get(block=block, timeout=1.0 if block else None)
+            except Empty:
+                break
+            if sequence.future.set_running_or_notify_cancel():
+                joining.append(sequence)
+        if not joining:
+            return
+        try:
+            state = self.prefill(joining)
+        except Exception as e:
+            for sequence in joining:
+                sequence.future.set_exception(e)
+            return
+        self.merge(joining, state)
+
+    @torch.no_grad()
+    def prefill(self, sequences):
+        device = self.model.device
+        length = max(len(sequence.input_ids) for sequence in sequences)
+        input_ids = torch.full((len(sequences), length), self.config.pad_token_id, dtype=torch.long, device=device)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, sequence in enumerate(sequences):
+            input_ids[i, :len(sequence.input_ids)] = torch.tensor(sequence.input_ids, device=device)
+            attention_mask[i, :len(sequence.input_ids)] = 1
+
+        encoder_outputs = self.model.get_encoder()(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+        decoder_input_ids = torch.full(
+            (len(sequences), 1), self.config.decoder_start_token_id, dtype=torch.long, device=device)
+        outputs = self.model(
+            encoder_outputs=encoder_outputs,
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        next_tokens = self.select(sequences, decoder_input_ids, outputs.logits[:, -1, :])
+        return {
+            'encoder_hidden_states': encoder_outputs.last_hidden_state,
+            'encoder_mask': attention_mask,
+            'decoder_mask': torch.ones_like(decoder_input_ids),
+            'decoder_ids': torch.cat([decoder_input_ids, next_tokens[:, None]], dim=1),
+            'past_key_values': [list(layer) for layer in outputs.past_key_values],
+        }
+
+    def select(self, sequences, decoder_ids, logits):
+        """
+        Append the next token of every row. `decoder_ids` holds the tokens
+        decoded so far, left-padded. N-gram blocking and min length are
+        applied to all rows at once; rows with a repetition penalty or
+        sampling then go through their own processors.
+        """
+        lengths = torch.tensor([len(sequence.tokens) for sequence in sequences], device=logits.device)
+        num_padding = decoder_ids.shape[1] - lengths
+        min_lengths = torch.tensor([sequence.min_length for sequence in sequences], device=logits.device)
+        scores = MinLengthProcessor(min_lengths, self.config.eos_token_id, lengths=lengths)(decoder_ids, logits)
+        for ngram_size in set(sequence.ngram_size for sequence in sequences) - {0}:
+            rows = torch.tensor([i for i, sequence in enumerate(sequences) if sequence.ngram_size == ngram_size],
+                                device=logits.device)
+            banned_rows, banned_tokens = repeated_ngram_bans(decoder_ids[rows], ngram_size, num_padding[rows])
+            scores[rows[banned_rows], banned_tokens] = -float('inf')
+
+        next_tokens = scores.argmax(-1)
+        for i, sequence in enumerate(sequences):
+            if sequence.processors or sequence.do_sample:
+                next_tokens[i] = sequence.next_token(scores[i])
+        for sequence, token in zip(sequences, next_tokens.tolist()):
+            sequence.tokens.append(token)
+        return next_tokens
+
+    def merge(self, sequences, state):
+        if self.state is None:
+            self.running, self.state = sequences, state
+            return
+        old = self.state
+        encoder_length = max(old['encoder_mask'].shape[1], state['encoder_mask'].shape[1])
+        decoder_length = max(old['decoder_mask'].shape[1], state['decoder_mask'].shape[1])
+
+        def cat(key, dim, length, left):
+            return torch.cat([pad_to(old[key], dim, length, left), pad_to(state[key], dim, length, left)])
+
+        merged = {
+            'encoder_hidden_states': cat('encoder_hidden_states', 1, encoder_length, False),
+            'encoder_mask': cat('encoder_mask', 1, encoder_length, False),
+            'decoder_mask': cat('decoder_mask', 1, decoder_length, True),
+            'decoder_ids': cat('decoder_ids', 1, decoder_length + 1, True),
+            'past_key_values': [],
+        }
+        for old_layer, new_layer in zip(old['past_key_values'], state['past_key_values']):
+            # self-attention key/value, then cross-attention key/value
+            lengths, left = (decoder_length, decoder_length, encoder_length, encoder_length), (True, True, False, False)
+            merged['past_key_values'].append([
+                torch.cat([pad_to(a, 2, n, l), pad_to(b, 2, n, l)])
+                for a, b, n, l in zip(old_layer, new_layer, lengths, left)
+            ])
+        self.running, self.state = self.running + sequences, merged
+
+    @torch.no_grad()
+    def step(self):
+        state = self.state
+        decoder_mask = torch.cat([state['decoder_mask'], state['decoder_mask'].new_ones((len(self.running), 1))], dim=1)
+        decoder_input_ids = state['decoder_ids'][:, -1:]
+        outputs = self.model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=state['encoder_hidden_states']),
+            attention_mask=state['encoder_mask'],
+            decoder_input_ids=decoder_input_ids,
+            decoder_attention_mask=decoder_mask,
+            past_key_values=state['past_key_values'],
+            use_cache=True,
+            return_dict=True,
+        )
+        state['decoder_mask'] = decoder_mask
+        state['past_key_values'] = [list(layer) for layer in outputs.past_key_values]
+        next_tokens = self.select(self.running, state['decoder_ids'], outputs.logits[:, -1, :])
+        state['decoder_ids'] = torch.cat([state['decoder_ids'], next_tokens[:, None]], dim=1)
+        self.steps += 1
+
+    def retire(self):
+        """
+        Hand out finished sequences, drop abandoned ones and shrink the
+        batch tensors to the rows that keep running.
+        """
+        now = time.monotonic()
+        keep = []
+        for i, sequence in enumerate(self.running):
+            if self.is_abandoned(sequence, now):
+                sequence.future.set_exception(DeadlineExceeded())
+            elif sequence.finished:
+                sequence.future.set_result(self.tokenizer.decode(sequence.tokens, skip_special_tokens=True))
+            else:
+                keep.append(i)
+                continue
+            with self.lock:
+                self.abandoned.discard(sequence.future)
+        if len(keep) == len(self.running):
+            return
+        if not keep:
+            self.running, self.state = [], None
+            return
+
+        state = self.state
+        rows = torch.tensor(keep, device=state['encoder_mask'].device)
+        decoder_mask = state['decoder_mask'][rows]
+        encoder_mask = state['encoder_mask'][rows]
+        # cut the padding columns no remaining row needs
+        start = int((decoder_mask.shape[1] - decoder_mask.sum(dim=1)).min())
+        end = int(encoder_mask.sum(dim=1).max())
+        self.state = {
+            'encoder_hidden_states': state['encoder_hidden_states'][rows, :end],
+            'encoder_mask': encoder_mask[:, :end],
+            'decoder_mask': decoder_mask[:, start:],
+            'decoder_ids': state['decoder_ids'][rows, start:],
+            'past_key_values': [
+                [layer[0][rows, :, start:], layer[1][rows, :, start:], layer[2][rows, :, :end], layer[3][rows, :, :end]]
+                for layer in state['past_key_values']
+            ],
+        }
+        self.running = [self.running[i] for i in keep]
+
+    def run(self):
+        while True:
+            try:
+                self.admit()
+                self.retire()
+                if self.running:
+                    self.step()
+                    self.retire()
+            except Exception as e:
+                for sequence in self.running:
+                    sequence.future.set_exception(e)
+                self.running, self.state = [], None
+
+    def start(self):
+        worker = Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+        return worker
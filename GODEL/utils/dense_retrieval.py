@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Dense retrieval over a memory-mapped float16 embedding matrix
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+
+class TextEncoder(object):
+    """
+    Mean-pooled, L2-normalized embeddings from a transformers encoder (the
+    encoder half of encoder-decoder checkpoints), e.g.
+    `sentence-transformers/all-MiniLM-L6-v2`.
+    """
+
+    def __init__(self, model_name_or_path, device='cpu', max_length=256):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+        model = AutoModel.from_pretrained(model_name_or_path)
+        if model.config.is_encoder_decoder:
+            model = model.get_encoder()
+        self.model = model.to(device).eval()
+        self.device = device
+        self.max_length = max_length
+
+    @torch.no_grad()
+    def encode(self, texts, batch_size=64):
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors='pt').to(self.device)
+            hidden = self.model(**inputs).last_hidden_state
+            mask = inputs['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1)
+            embeddings.append(torch.nn.functional.normalize(pooled, dim=-1).float().cpu().numpy())
+        return np.concatenate(embeddings) if embeddings else np.zeros((0, self.model.config.hidden_size), np.float32)
+
+
+def kmeans(vectors, num_lists, iterations=10, seed=0):
+    """
+    Spherical k-means centroids of the (unit) rows of `vectors`.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = (vectors @ centroids.T).argmax(1)
+        for i in range(num_lists):
+            members = vectors[assignment == i]
+            if len(members):
+                centroid = members.sum(0)
+                centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids
+
+
+def top_k(ids, scores, k):
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[top], scores[top]
+    order = np.argsort(-scores, kind='stable')
+    return ids[order], scores[order]
+
+
+class DenseIndex(object):
+    """
+    Inner-product search over unit embeddings stored as one float16 matrix.
+
+    Without partitions every query scans the whole matrix, `block_size`
+    rows at a time, with one matrix multiplication per block for all
+    queries of a batch. With IVF partitions (`num_lists` k-means centroids)
+    the rows are stored grouped by their nearest centroid and a query only
+    scans the `nprobe` lists whose centroids are closest to it. As the
+    matrix is memory-mapped, only the pages of the lists being probed have
+    to be in RAM.
+    """
+
+    def __init__(self, keys, embeddings, centroids=None, list_offsets=None, block_size=16384):
+        self.keys = keys
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, index_dir, keys, embeddings, num_lists=0, sample_size=100000, seed=0):
+        """
+        Write the index of `keys` and their `embeddings` (an array of unit
+        rows, possibly memory-mapped) to `index_dir`.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        meta = {'keys': list(keys), 'dim': int(embeddings.shape[1])}
+        if not num_lists:
+            order = np.arange(len(keys))
+        else:
+            rng = np.random.default_rng(seed)
+            sample = np.asarray(embeddings[np.sort(rng.choice(len(keys), min(sample_size, len(keys)),
+                                                              replace=False))], dtype=np.float32)
+            centroids = kmeans(sample, num_lists, seed=seed)
+            assignment = np.concatenate([
+                (np.asarray(embeddings[start:start + 65536], dtype=np.float32) @ centroids.T).argmax(1)
+                for start in range(0, len(keys), 65536)])
+            order = np.argsort(assignment, kind='stable')
+            list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+            np.cumsum(np.bincount(assignment, minlength=num_lists), out=list_offsets[1:])
+            np.save(os.path.join(index_dir, 'centroids.npy'), centroids)
+            np.save(os.path.join(index_dir, 'list_offsets.npy'), list_offsets)
+            meta['keys'] = [meta['keys'][i] for i in order]
+
+        matrix = np.lib.format.open_memmap(os.path.join(index_dir, 'embeddings.npy'), mode='w+',
+                                           dtype=np.float16, shape=(len(keys), meta['dim']))
+        for start in range(0, len(keys), 65536):
+            matrix[start:start + 65536] = embeddings[order[start:start + 65536]]
+        matrix.flush()
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        # copy-on-write so torch can wrap the pages without copying them
+        embeddings = np.load(os.path.join(index_dir, 'embeddings.npy'), mmap_mode='c')
+        centroids = list_offsets = None
+        if os.path.exists(os.path.join(index_dir, 'centroids.npy')):
+            centroids = np.load(os.path.join(index_dir, 'centroids.npy'))
+            list_offsets = np.load(os.path.join(index_dir, 'list_offsets.npy'))
+        return cls(meta['keys'], embeddings, centroids, list_offsets)
+
+    def scan(self, queries, start, end, k):
+        """
+        Top `k` (row ids, scores) of the rows `start:end` for each query.
+        """
+        best_scores = queries.new_zeros((len(queries), 0))
+        best_ids = torch.zeros((len(queries), 0), dtype=torch.long)
+        for block_start in range(start, end, self.block_size):
+            block_end = min(block_start + self.block_size, end)
+            block = torch.from_numpy(self.embeddings[block_start:block_end]).float()
+            scores = torch.cat([best_scores, queries @ block.T], dim=1)
+            ids = torch.cat([best_ids, torch.arange(block_start, block_end).expand(len(queries), -1)], dim=1)
+            top = scores.topk(min(k, scores.shape[1]), dim=1)
+            best_scores, best_ids = top.values, ids.gather(1, top.indices)
+        return list(zip(best_ids.numpy(), best_scores.numpy()))
+
+    def search(self, queries, k=5, nprobe=8):
+        """
+        The keys of the `k` best rows for each of the query embeddings
+        `queries` (a [num_queries, dim] array), best first.
+        """
+        queries = torch.as_tensor(np.asarray(queries, dtype=np.float32))
+        if self.centroids is None:
+            return [[self.keys[i] for i in ids] for ids, _ in self.scan(queries, 0, len(self.keys), k)]
+
+        probes = np.argsort(-(queries.numpy() @ self.centroids.T), axis=1)[:, :nprobe]
+        # queries probing the same list are scored together
+        candidates = [([], []) for _ in queries]
+        for list_id in np.unique(probes):
+            members = np.flatnonzero((probes == list_id).any(1))
+            start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            for i, (ids, scores) in zip(members, self.scan(queries[members], start, end, k)):
+                candidates[i][0].append(ids)
+                candidates[i][1].append(scores)
+        results = []
+        for ids, scores in candidates:
+            if not ids:
+                results.append([])
+                continue
+            ids, _ = top_k(np.concatenate(ids), np.concatenate(scores), k)
+            results.append([self.keys[i] for i in ids])
+        return results
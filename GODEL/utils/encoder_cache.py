@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Encoder outputs reused across requests with the same input ids
+"""
+
+import hashlib
+import itertools
+import weakref
+from threading import Lock
+
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+from GODEL.utils.cache import LRUCache
+
+
+def tensor_bytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+
+class EncoderCache(object):
+    """
+    Encoder hidden states of single inputs, without their padding, keyed by
+    the model and a hash of the input ids and evicted least recently used
+    above `max_bytes`. A regenerated or resampled input, or one repeated
+    within a batch, only goes through the decoder.
+
+    Models are told apart by a number given on first use rather than by
+    `id()`, which a model loaded after an evicted one could reuse.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.cache = LRUCache(max_bytes, sizeof=tensor_bytes)
+        self.model_numbers = weakref.WeakKeyDictionary()
+        self.counter = itertools.count()
+        self.lock = Lock()
+
+    def key(self, model, ids):
+        with self.lock:
+            if model not in self.model_numbers:
+                self.model_numbers[model] = next(self.counter)
+            number = self.model_numbers[model]
+        return number, hashlib.blake2b(ids.numpy().tobytes(), digest_size=16).hexdigest()
+
+    @torch.no_grad()
+    def encode(self, model, input_ids, attention_mask):
+        """
+        Encoder outputs of the padded batch `input_ids`; only the inputs
+        missing from the cache are run through the encoder.
+        """
+        mask = attention_mask.bool()
+        cpu_ids, cpu_mask = input_ids.cpu(), mask.cpu()
+        keys = [self.key(model, ids[row_mask]) for ids, row_mask in zip(cpu_ids, cpu_mask)]
+        states = {}
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in states or key in missing:
+                continue
+            value = self.cache.get(key)
+            if value is None:
+                missing[key] = i
+            else:
+                states[key] = value
+
+        if missing:
+            rows = list(missing.values())
+            hidden = model.get_encoder()(
+                input_ids=input_ids[rows], attention_mask=attention_mask[rows], return_dict=True).last_hidden_state
+            for key, row, row_hidden in zip(missing, rows, hidden):
+                # copied out of the batch tensor so an entry holds only its own rows
+                states[key] = row_hidden[mask[row]].clone()
+                self.cache.put(key, states[key])
+
+        first = states[keys[0]]
+        last_hidden_state = first.new_zeros((len(keys), input_ids.shape[1], first.shape[-1]))
+        for i, key in enumerate(keys):
+            last_hidden_state[i, mask[i]] = states[key]
+        return BaseModelOutput(last_hidden_state=last_hidden_state)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
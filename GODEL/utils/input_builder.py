@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Token-budgeted encoder inputs shared by training and serving
+"""
+
+
+class InputBuilder(object):
+    """
+    Build `context <|knowledge|> knowledge =>` encoder inputs under separate
+    token budgets for the context and the knowledge.
+
+    When the context is over budget the oldest turns are dropped first (and
+    the left of the oldest kept turn is cut if the newest turn alone does not
+    fit). The knowledge is cut from the right. The prompt markers and the
+    final eos are always kept. A budget of None means no limit.
+
+    With `max_length` the whole input is then kept to at most that many
+    tokens, so a part without a budget stays bounded: the knowledge is cut
+    from the right first, then the context from the left, and the markers
+    and eos are still kept.
+    """
+
+    def __init__(self, tokenizer, knowledge_marker=' <|knowledge|> ', end_marker=' =>',
+                 turn_separator=' EOS ', max_context_length=None, max_knowledge_length=None, max_length=None):
+        self.tokenizer = tokenizer
+        self.turn_separator = turn_separator
+        self.max_context_length = max_context_length
+        self.max_knowledge_length = max_knowledge_length
+        self.max_length = max_length
+        # segments are tokenized separately and every segment after a marker
+        # starts with its own word boundary, so trailing spaces are dropped to
+        # get the same ids as tokenizing the joined string (for the same
+        # reason turns and knowledge are stripped)
+        self.knowledge_marker_ids = self.encode(knowledge_marker.rstrip())
+        self.end_marker_ids = self.encode(end_marker)
+        self.separator_ids = self.encode(turn_separator.rstrip())
+
+    def encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def encode_turns(self, turns):
+        return [self.encode(turn.strip()) for turn in turns]
+
+    def context_ids(self, turns=None, turn_ids=None):
+        if turn_ids is None:
+            if self.max_context_length is None:
+                # no budget: tokenize the joined history in one call
+                return self.encode(self.turn_separator.join(turn.strip() for turn in turns))
+            turn_ids = self.encode_turns(turns)
+        if not turn_ids:
+            return []
+
+        budget = self.max_context_length
+        kept = [turn_ids[-1]]
+        length = len(turn_ids[-1])
+        for ids in reversed(turn_ids[:-1]):
+            if budget is not None and length + len(self.separator_ids) + len(ids) > budget:
+                break
+            kept.insert(0, ids)
+            length += len(self.separator_ids) + len(ids)
+
+        context_ids = list(kept[0])
+        for ids in kept[1:]:
+            context_ids += self.separator_ids + ids
+        if budget is not None and len(context_ids) > budget:
+            context_ids = context_ids[len(context_ids) - budget:]
+        return context_ids
+
+    def knowledge_ids(self, knowledge=None, knowledge_ids=None):
+        if knowledge_ids is None:
+            knowledge_ids = self.encode(knowledge.strip()) if knowledge else []
+        if self.max_knowledge_length is not None:
+            knowledge_ids = knowledge_ids[:self.max_knowledge_length]
+        return knowledge_ids
+
+    def build(self, turns=None, knowledge=None, turn_ids=None, knowledge_ids=None, use_knowledge=True):
+        """
+        Encoder input ids from either raw `turns` / `knowledge` or their
+        pre-tokenized `turn_ids` / `knowledge_ids`.
+        """
+        context_ids = self.context_ids(turns, turn_ids)
+        knowledge_ids = self.knowledge_ids(knowledge, knowledge_ids) if use_knowledge else []
+        marker_ids = self.knowledge_marker_ids if use_knowledge else []
+        if self.max_length is not None:
+            room = max(self.max_length - len(marker_ids) - len(self.end_marker_ids) - 1, 0)
+            knowledge_ids = knowledge_ids[:max(room - len(context_ids), 0)]
+            context_ids = context_ids[max(len(context_ids) - room, 0):]
+        return context_ids + marker_ids + knowledge_ids + self.end_marker_ids + [self.tokenizer.eos_token_id]
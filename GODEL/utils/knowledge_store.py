@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Pre-tokenized knowledge documents for serving
+"""
+
+import json
+import re
+
+
+class KnowledgeStore(object):
+    """
+    Knowledge snippets tokenized once at load time, so requests can refer
+    to them by id instead of sending (and re-tokenizing) the raw text.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.docs = {}
+        self.ids = {}
+
+    @classmethod
+    def from_dstc9(cls, filepath, tokenizer):
+        store = cls(tokenizer)
+        store.load_dstc9(filepath)
+        return store
+
+    def load_dstc9(self, filepath):
+        """
+        Load a DSTC9 `knowledge.json`. Documents are keyed by
+        `domain/entity_id/doc_id` and formatted as in `converter.py`.
+        """
+        kbs = json.load(open(filepath))
+        for domain, entities in kbs.items():
+            for entity_id, entity in entities.items():
+                for doc_id, doc in entity['docs'].items():
+                    title, body = doc['title'], doc['body']
+                    self.add(f'{domain}/{entity_id}/{doc_id}', f'Q: {title} A: {body}')
+
+    def load_facts(self, filepath):
+        """
+        Load a DSTC7 grounded `*.facts.txt` file (hash, subreddit,
+        conversation id, domain, fact). Facts are keyed by
+        `conversation_id/line` and stripped of their html tags. Facts files
+        are large, so they are tokenized on first use only.
+        """
+        with open(filepath, encoding='utf-8') as f:
+            for line_number, line in enumerate(f):
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 5:
+                    continue
+                fact = ' '.join(re.sub(r'</?[a-z0-9]+>', ' ', fields[4]).split())
+                if fact:
+                    self.add(f'{fields[2]}/{line_number}', fact, tokenize=False)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, key):
+        return key in self.docs
+
+    def add(self, key, text, tokenize=True):
+        # stripped like the knowledge of InputBuilder, so the joined ids of
+        # several documents match tokenizing their joined text
+        self.docs[key] = text.strip()
+        if tokenize:
+            self.token_ids(key)
+
+    def token_ids(self, key):
+        if key not in self.ids:
+            self.ids[key] = self.tokenizer(self.docs[key], add_special_tokens=False).input_ids
+        return self.ids[key]
+
+    def text(self, keys):
+        return ' '.join(self.docs[key] for key in keys)
+
+    def get_ids(self, keys):
+        """
+        Token ids of the given documents joined in order, equivalent to
+        tokenizing `self.text(keys)`.
+        """
+        ids = []
+        for key in keys:
+            ids.extend(self.token_ids(key))
+        return ids
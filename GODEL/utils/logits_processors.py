@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Tensorized replacements for the n-gram blocking and min-length processors
+"""
+
+import torch
+from transformers import LogitsProcessor
+
+
+def repeated_ngram_bans(input_ids, ngram_size, num_padding=None):
+    """
+    (rows, tokens) of the next tokens that would complete an n-gram already
+    in `input_ids` ([batch, length]). All n-gram windows of every row are
+    compared with the row's last `ngram_size - 1` tokens at once on the
+    device of `input_ids`, instead of building a dict per hypothesis in
+    Python. With `num_padding`, rows are left-padded by that many tokens
+    and windows starting in the padding are ignored.
+    """
+    length = input_ids.shape[1]
+    if length < ngram_size:
+        return input_ids.new_zeros(0), input_ids.new_zeros(0)
+    windows = input_ids.unfold(1, ngram_size, 1)
+    suffix = input_ids[:, length - ngram_size + 1:]
+    matches = (windows[:, :, :-1] == suffix[:, None, :]).all(-1)
+    if num_padding is not None:
+        matches &= torch.arange(windows.shape[1], device=input_ids.device)[None, :] >= num_padding[:, None]
+    rows, starts = matches.nonzero(as_tuple=True)
+    return rows, windows[rows, starts, -1]
+
+
+class NoRepeatNGramProcessor(LogitsProcessor):
+    """
+    Same bans as transformers' `NoRepeatNGramLogitsProcessor`, computed
+    with tensor ops, so its cost no longer grows with a Python loop over
+    batch x beams x length.
+    """
+
+    def __init__(self, ngram_size):
+        if not isinstance(ngram_size, int) or ngram_size <= 0:
+            raise ValueError(f'`ngram_size` has to be a strictly positive integer, but is {ngram_size}')
+        self.ngram_size = ngram_size
+
+    def __call__(self, input_ids, scores):
+        rows, tokens = repeated_ngram_bans(input_ids, self.ngram_size)
+        scores[rows, tokens] = -float('inf')
+        return scores
+
+
+class MinLengthProcessor(LogitsProcessor):
+    """
+    Forbid eos before `min_length` tokens. Unlike transformers'
+    `MinLengthLogitsProcessor`, rows may have their own `min_length` and
+    current `lengths` (tensors), e.g. left-padded rows of a continuous batch.
+    """
+
+    def __init__(self, min_length, eos_token_id, lengths=None):
+        self.min_length = min_length
+        self.eos_token_ids = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id)
+        self.lengths = lengths
+
+    def __call__(self, input_ids, scores):
+        lengths = input_ids.shape[-1] if self.lengths is None else self.lengths
+        too_short = torch.as_tensor(lengths < self.min_length, device=scores.device)
+        if too_short.dim() == 0:
+            if too_short:
+                scores[:, self.eos_token_ids] = -float('inf')
+            return scores
+        for eos_token_id in self.eos_token_ids:
+            scores[:, eos_token_id].masked_fill_(too_short, -float('inf'))
+        return scores
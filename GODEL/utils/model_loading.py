@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Fast checkpoint loading from memory-mapped safetensors
+"""
+
+import json
+import os
+
+from transformers import AutoModelForSeq2SeqLM
+from transformers.modeling_utils import no_init_weights
+
+
+SAFETENSORS_FILE = 'model.safetensors'
+
+
+def has_safetensors(model_dir):
+    return os.path.isfile(os.path.join(model_dir, SAFETENSORS_FILE))
+
+
+def save_safetensors(model, model_dir):
+    """
+    Write `model.safetensors` next to a `save_pretrained` checkpoint. Tied
+    weights are stored once and recorded in the metadata.
+    """
+    from safetensors.torch import save_file
+
+    state_dict, tied, seen = {}, {}, {}
+    for name, tensor in model.state_dict().items():
+        ptr = tensor.data_ptr()
+        if ptr in seen:
+            tied[name] = seen[ptr]
+            continue
+        seen[ptr] = name
+        state_dict[name] = tensor.contiguous()
+    save_file(state_dict, os.path.join(model_dir, SAFETENSORS_FILE),
+              metadata={'format': 'pt', 'tied': json.dumps(tied)})
+
+
+def load_safetensors(model_dir, config, device='cpu'):
+    """
+    Build the model without running weight init and take its tensors from
+    the memory-mapped file. On torch versions with `load_state_dict(assign=)`
+    the mapped tensors become the parameters, otherwise they are copied once.
+    """
+    from safetensors import safe_open
+
+    with no_init_weights():
+        model = AutoModelForSeq2SeqLM.from_config(config)
+
+    with safe_open(os.path.join(model_dir, SAFETENSORS_FILE), framework='pt', device=str(device)) as f:
+        tied = json.loads((f.metadata() or {}).get('tied', '{}'))
+        state_dict = {name: f.get_tensor(name) for name in f.keys()}
+
+    try:
+        missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    except TypeError:
+        missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    model.tie_weights()
+    # weights stored once (by save_safetensors, or by save_pretrained without
+    # `tied` metadata) are filled in by tie_weights: they now share memory
+    # with a loaded weight
+    state = model.state_dict()
+    loaded = {state[name].data_ptr() for name in state_dict if name in state}
+    missing = [name for name in missing if name not in tied and state[name].data_ptr() not in loaded]
+    if missing or unexpected:
+        raise ValueError(f'{SAFETENSORS_FILE} does not match the config: missing {missing}, unexpected {unexpected}')
+    return model.eval()
+
+
+if __name__ == '__main__':
+    import sys
+
+    from transformers import AutoConfig
+
+    # python GODEL/utils/model_loading.py CKPT
+    model_dir = sys.argv[1]
+    config = AutoConfig.from_pretrained(model_dir)
+    save_safetensors(AutoModelForSeq2SeqLM.from_pretrained(model_dir, config=config), model_dir)
+    print(f'Wrote {os.path.join(model_dir, SAFETENSORS_FILE)}')
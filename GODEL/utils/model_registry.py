@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Several named checkpoints in one server process
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+import torch
+
+
+WEIGHT_FILES = ('model.safetensors', 'pytorch_model.bin')
+
+
+def model_bytes(model):
+    if not isinstance(model, torch.nn.Module):
+        return 0
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def checkpoint_bytes(path):
+    """
+    Size of the weights on disk, used to make room before a model is loaded.
+    """
+    for filename in WEIGHT_FILES:
+        filepath = os.path.join(path, filename)
+        if os.path.isfile(filepath):
+            return os.path.getsize(filepath)
+    return 0
+
+
+def vocab_fingerprint(tokenizer):
+    vocab = sorted(tokenizer.get_vocab().items())
+    special = sorted(tokenizer.special_tokens_map.items())
+    return hashlib.sha1(json.dumps([vocab, special]).encode('utf-8')).hexdigest()
+
+
+class ModelRegistry(object):
+    """
+    Load named checkpoints on first use and evict the least recently used
+    ones once their weights exceed `max_bytes`. Pinned models (the server's
+    default) are never evicted. Checkpoints with identical vocabularies
+    share one tokenizer instance.
+    """
+
+    def __init__(self, load_model, load_tokenizer, max_bytes=None):
+        self.load_model = load_model
+        self.load_tokenizer = load_tokenizer
+        self.max_bytes = max_bytes
+        self.paths = {}
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.pinned = set()
+        self.tokenizers = {}
+        # name -> Future of a load in progress, later callers wait on it
+        self.loading = {}
+        self.loads = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def add(self, name, path):
+        self.paths[name] = path
+
+    def pin(self, name, model, tokenizer):
+        with self.lock:
+            tokenizer = self.tokenizers.setdefault(vocab_fingerprint(tokenizer), tokenizer)
+            self.models[name] = (model, tokenizer)
+            self.sizes[name] = model_bytes(model)
+            self.pinned.add(name)
+
+    def __contains__(self, name):
+        return name in self.paths or name in self.models
+
+    def get(self, name):
+        """
+        Return the (model, tokenizer) registered as `name`, loading it if
+        needed. The lock is only held for the bookkeeping, so a cold load
+        does not hold up callers of the models already loaded; concurrent
+        callers of the same cold model share its load.
+        """
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+            if name not in self.paths:
+                raise KeyError(f'Unknown model {name}')
+            loading = self.loading.get(name)
+            owner = loading is None
+            if owner:
+                loading = self.loading[name] = Future()
+                path = self.paths[name]
+                self.make_room(checkpoint_bytes(path), keep=name)
+        if not owner:
+            return loading.result()
+
+        try:
+            tokenizer = self.load_tokenizer(path)
+            model = self.load_model(path)
+        except Exception as e:
+            with self.lock:
+                del self.loading[name]
+            loading.set_exception(e)
+            raise
+        with self.lock:
+            tokenizer = self.tokenizers.setdefault(vocab_fingerprint(tokenizer), tokenizer)
+            self.models[name] = (model, tokenizer)
+            self.sizes[name] = model_bytes(model)
+            self.loads += 1
+            # loads running side by side may each have made room only for
+            # themselves
+            self.make_room(0, keep=name)
+            del self.loading[name]
+            entry = self.models[name]
+        loading.set_result(entry)
+        return entry
+
+    def make_room(self, nbytes, keep=None):
+        if self.max_bytes is None:
+            return
+        for name in list(self.models):
+            if sum(self.sizes.values()) + nbytes <= self.max_bytes:
+                break
+            if name in self.pinned or name == keep:
+                continue
+            # in-flight batches keep their own reference, the weights are
+            # freed once they finish
+            del self.models[name]
+            del self.sizes[name]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'loaded': list(self.models),
+            'loading': list(self.loading),
+            'available': sorted(set(self.paths) | set(self.models)),
+            'bytes': sum(self.sizes.values()),
+            'max_bytes': self.max_bytes,
+            'shared_tokenizers': len(self.tokenizers),
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
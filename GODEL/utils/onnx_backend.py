@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+onnxruntime backend for graphs written by `export_onnx.py`
+"""
+
+import os
+
+import numpy as np
+import torch
+from transformers import (
+    AutoConfig,
+    LogitsProcessorList,
+)
+
+from GODEL.export_onnx import DECODER_FILE, DECODER_WITH_PAST_FILE, ENCODER_FILE, past_names
+from GODEL.utils.logits_processors import MinLengthProcessor, NoRepeatNGramProcessor
+
+
+class OnnxSeq2Seq(object):
+    """
+    Greedy encoder-decoder generation on onnxruntime. The encoder runs once,
+    then the decoder-with-past graph is fed one token per step together with
+    the cached key/values, so each step costs the same regardless of how
+    many tokens were already generated.
+    """
+
+    def __init__(self, model_dir, num_threads=None):
+        import onnxruntime
+
+        self.config = AutoConfig.from_pretrained(model_dir)
+        self.device = torch.device('cpu')
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+
+        def session(filename):
+            return onnxruntime.InferenceSession(
+                os.path.join(model_dir, filename), options, providers=['CPUExecutionProvider'])
+
+        self.encoder = session(ENCODER_FILE)
+        self.decoder = session(DECODER_FILE)
+        self.decoder_with_past = session(DECODER_WITH_PAST_FILE)
+        self.past_names = past_names(self.config.num_decoder_layers, 'past_key_values')
+
+    def generate(self, input_ids, attention_mask=None, max_length=None, min_length=0,
+                 no_repeat_ngram_size=0, num_beams=1, do_sample=False, repetition_penalty=1.0, **kwargs):
+        if num_beams > 1 or do_sample:
+            raise ValueError('The onnx backend only supports greedy decoding')
+        if repetition_penalty != 1.0:
+            raise ValueError('The onnx backend does not support repetition_penalty')
+        config = self.config
+        max_length = max_length or config.max_length
+        if attention_mask is None:
+            attention_mask = (input_ids != config.pad_token_id).long()
+        logits_processor = LogitsProcessorList()
+        if min_length:
+            logits_processor.append(MinLengthProcessor(min_length, config.eos_token_id))
+        if no_repeat_ngram_size:
+            logits_processor.append(NoRepeatNGramProcessor(no_repeat_ngram_size))
+
+        input_ids = input_ids.cpu().numpy().astype(np.int64)
+        encoder_attention_mask = attention_mask.cpu().numpy().astype(np.int64)
+        encoder_hidden_states = self.encoder.run(
+            None, {'input_ids': input_ids, 'attention_mask': encoder_attention_mask})[0]
+
+        batch_size = input_ids.shape[0]
+        decoder_input_ids = torch.full((batch_size, 1), config.decoder_start_token_id, dtype=torch.long)
+        unfinished = torch.ones(batch_size, dtype=torch.long)
+        inputs = {
+            'decoder_input_ids': decoder_input_ids.numpy(),
+            'encoder_hidden_states': encoder_hidden_states,
+            'encoder_attention_mask': encoder_attention_mask,
+        }
+        outputs = self.decoder.run(None, inputs)
+        while True:
+            scores = logits_processor(decoder_input_ids, torch.from_numpy(outputs[0][:, -1, :]))
+            next_tokens = torch.argmax(scores, dim=-1)
+            next_tokens = next_tokens * unfinished + config.pad_token_id * (1 - unfinished)
+            decoder_input_ids = torch.cat([decoder_input_ids, next_tokens[:, None]], dim=-1)
+            unfinished = unfinished.mul((next_tokens != config.eos_token_id).long())
+            if unfinished.max() == 0 or decoder_input_ids.shape[-1] >= max_length:
+                break
+
+            inputs['decoder_input_ids'] = next_tokens[:, None].numpy()
+            inputs.update(zip(self.past_names, outputs[1:]))
+            outputs = self.decoder_with_past.run(None, inputs)
+        return decoder_input_ids
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Pre-fork serving: load the model once, fork one pinned worker per core set
+"""
+
+import gc
+import logging
+import os
+import signal
+import socket
+
+import torch
+from werkzeug.serving import make_server
+
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_sets(num_workers, cpus=None):
+    """
+    Split the usable cpus into `num_workers` contiguous sets of (nearly)
+    equal size. With fewer cpus than workers, workers share cpus.
+    """
+    cpus = sorted(cpus or os.sched_getaffinity(0))
+    if num_workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(num_workers)]
+    size, extra = divmod(len(cpus), num_workers)
+    sets, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (i < extra)
+        sets.append(cpus[start:end])
+        start = end
+    return sets
+
+
+def listen(host, port, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class PreforkServer(object):
+    """
+    Serve `app` from `num_workers` forked processes that accept on one shared
+    listening socket, so the kernel spreads connections over them.
+
+    Everything loaded before `serve()` (the model weights) is shared
+    copy-on-write with the workers. The garbage collector is frozen before
+    forking so that collections in the workers do not write to the pages of
+    the parent's objects. Each worker is pinned to its own cpu set with a
+    matching number of torch threads, then calls `start_worker(index)` to
+    start what cannot survive a fork (threads, queues). Workers that die are
+    forked again.
+    """
+
+    def __init__(self, app, host='127.0.0.1', port=8082, num_workers=None, start_worker=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = num_workers or len(os.sched_getaffinity(0))
+        self.start_worker = start_worker
+        self.cpu_sets = cpu_sets(self.num_workers)
+        self.workers = {}
+        self.stopping = False
+
+    def serve(self):
+        if torch.cuda.is_initialized():
+            raise RuntimeError('CUDA is initialized, forked workers cannot use it: serve the model on the CPU')
+        self.sock = listen(self.host, self.port)
+        gc.collect()
+        gc.freeze()
+        for index in range(self.num_workers):
+            self.fork(index)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(f'Serving on {self.host}:{self.port} with {self.num_workers} workers')
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            index = self.workers.pop(pid, None)
+            if index is not None and not self.stopping:
+                logger.warning(f'Worker {index} (pid {pid}) exited with status {status}, restarting')
+                self.fork(index)
+
+    def fork(self, index):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = index
+            return
+        # worker process, never returns into the parent's loop
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            cpus = self.cpu_sets[index]
+            os.sched_setaffinity(0, cpus)
+            torch.set_num_threads(len(cpus))
+            if self.start_worker is not None:
+                self.start_worker(index)
+            logger.info(f'Worker {index} (pid {os.getpid()}) on cpus {cpus}')
+            make_server(self.host, self.port, self.app, threaded=True, fd=self.sock.fileno()).serve_forever()
+            status = 0
+        except BaseException:
+            logger.exception(f'Worker {index} failed')
+        finally:
+            os._exit(status)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
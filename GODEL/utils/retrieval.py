@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+BM25 retrieval over the knowledge store with a memory-mapped inverted index
+"""
+
+import json
+import logging
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+STOPWORDS = frozenset((
+    'a an and are as at be but by can could did do does for from had has have he her his how i if in into is it '
+    'its me my no not of on or our she so that the their them then there these they this to was we were what '
+    'when where which who will with would you your'
+).split())
+
+ARRAYS = ('offsets', 'doc_ids', 'weights')
+
+
+def terms(text):
+    return [term for term in re.findall(r'\w+', text.lower()) if term not in STOPWORDS]
+
+
+def fuse_rankings(rankings, k=60):
+    """
+    Reciprocal rank fusion of several rankings of document keys.
+    """
+    if len(rankings) == 1:
+        return list(rankings[0])
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0) + 1 / (k + rank + 1)
+    return sorted(scores, key=lambda key: -scores[key])
+
+
+class BM25Index(object):
+    """
+    Okapi BM25 over a fixed collection, stored as an inverted index in CSR
+    form: the postings of term `t` are `doc_ids[offsets[t]:offsets[t + 1]]`.
+    Each posting keeps its precomputed BM25 weight (idf times the saturated
+    term frequency), so scoring a query is a sum of posting weights over the
+    query terms and only touches the documents that contain them.
+
+    `save` writes the arrays as .npy files and `load` memory-maps them, so
+    a restart does not rebuild or even read the whole index.
+    """
+
+    def __init__(self, keys, vocab, offsets, doc_ids, weights):
+        self.keys = keys
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, docs, k1=1.2, b=0.75):
+        """
+        Index `docs`, a {key: text} dict.
+        """
+        keys, vocab = list(docs), {}
+        term_ids, doc_ids, tfs = [], [], []
+        lengths = np.zeros(len(keys), dtype=np.float32)
+        for i, key in enumerate(keys):
+            counts = Counter(terms(docs[key]))
+            lengths[i] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(i)
+                tfs.append(tf)
+
+        term_ids = np.array(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')
+        doc_ids = np.array(doc_ids, dtype=np.int32)[order]
+        tfs = np.array(tfs, dtype=np.float32)[order]
+        df = np.bincount(term_ids, minlength=len(vocab))
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:])
+
+        idf = np.log(1 + (len(keys) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1))
+        weights = np.repeat(idf, df) * tfs * (k1 + 1) / (tfs + norm[doc_ids])
+        return cls(keys, vocab, offsets, doc_ids, weights.astype(np.float32))
+
+    def save(self, index_dir, fingerprint=None):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(index_dir, name + '.npy'), getattr(self, name))
+        with open(os.path.join(index_dir, 'vocab.json'), 'w') as f:
+            json.dump(self.vocab, f)
+        # written last: an index without it is incomplete and gets rebuilt
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'keys': self.keys}, f)
+
+    @classmethod
+    def load(cls, index_dir, fingerprint=None):
+        """
+        Memory-map a saved index. Returns None when there is none or it was
+        built from other documents than `fingerprint` says.
+        """
+        try:
+            with open(os.path.join(index_dir, 'meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta['fingerprint'] != fingerprint:
+            return None
+        with open(os.path.join(index_dir, 'vocab.json')) as f:
+            vocab = json.load(f)
+        arrays = [np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r') for name in ARRAYS]
+        return cls(meta['keys'], vocab, *arrays)
+
+    @classmethod
+    def load_or_build(cls, index_dir, docs, fingerprint=None):
+        index = cls.load(index_dir, fingerprint)
+        if index is None:
+            logger.info(f'Building the BM25 index of {len(docs)} documents in {index_dir}')
+            cls.build(docs).save(index_dir, fingerprint)
+            index = cls.load(index_dir, fingerprint)
+        return index
+
+    def scores(self, query):
+        """
+        The ids of the documents sharing a term with `query` and their
+        scores.
+        """
+        doc_ids, weights = [], []
+        for term, count in Counter(terms(query)).items():
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            doc_ids.append(self.doc_ids[start:end])
+            weights.append(count * self.weights[start:end])
+        if not doc_ids:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        matched, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        return matched, np.bincount(inverse, weights=np.concatenate(weights))
+
+    def search(self, query, k=5):
+        """
+        The keys of the (at most) `k` best matching documents, best first.
+        """
+        matched, scores = self.scores(query)
+        if len(matched) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            matched, scores = matched[top], scores[top]
+        return [self.keys[i] for i in matched[np.argsort(-scores, kind='stable')]]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Scheduling policies for the generation queue
+"""
+
+import heapq
+import itertools
+import time
+from queue import Queue
+
+from GODEL.utils.metrics import metrics
+
+
+QUEUE_WAIT = metrics.histogram('godel_queue_wait_seconds', 'Time requests spent queued',
+                               labelnames=('priority_class',))
+
+
+class SchedulingPolicy(object):
+    """
+    Orders queued items by a key fixed when they are queued: the arrival
+    time plus a penalty in seconds. A queued item can only be overtaken by
+    items arriving less than its penalty after it, so nothing starves and
+    the longest extra wait is bounded by the largest penalty.
+
+    `cost(item)` estimates the work of an item (e.g. decoder tokens) and
+    `priority_class(item)` names its class; both are only called by the
+    policies that need them, the class also labels the wait metrics.
+    """
+
+    name = None
+
+    def __init__(self, cost=None, priority_class=None):
+        self.cost = cost
+        self.get_priority_class = priority_class
+
+    def priority_class(self, item):
+        return self.get_priority_class(item) if self.get_priority_class is not None else 'default'
+
+    def penalty(self, item):
+        return 0.0
+
+    def key(self, item, now):
+        return now + self.penalty(item)
+
+
+class FIFOPolicy(SchedulingPolicy):
+    name = 'fifo'
+
+
+class ShortestJobFirstPolicy(SchedulingPolicy):
+    """
+    Cheaper items first: an item waits behind later, cheaper ones for at
+    most `cost / cost_per_second` seconds.
+    """
+
+    name = 'sjf'
+
+    def __init__(self, cost, priority_class=None, cost_per_second=200.0):
+        super().__init__(cost, priority_class)
+        self.cost_per_second = cost_per_second
+
+    def penalty(self, item):
+        return self.cost(item) / self.cost_per_second
+
+
+class PriorityPolicy(SchedulingPolicy):
+    """
+    Priority classes given a head start in seconds (`delays`, e.g.
+    {'interactive': 0, 'batch': 10}): a batch item is served before newer
+    interactive ones once it has waited 10 seconds. FIFO within a class.
+    """
+
+    name = 'priority'
+
+    def __init__(self, priority_class, delays, cost=None):
+        super().__init__(cost, priority_class)
+        self.delays = delays
+
+    def penalty(self, item):
+        return self.delays.get(self.priority_class(item), 0.0)
+
+
+def get_policy(name, cost=None, priority_class=None, delays=None, cost_per_second=200.0):
+    if name == 'fifo':
+        return FIFOPolicy(cost, priority_class)
+    if name == 'sjf':
+        return ShortestJobFirstPolicy(cost, priority_class, cost_per_second=cost_per_second)
+    if name == 'priority':
+        return PriorityPolicy(priority_class, delays or {}, cost)
+    raise ValueError(f'Unknown scheduling policy {name}')
+
+
+class SchedulingQueue(Queue):
+    """
+    `queue.Queue` handing out items in the order of `policy` (FIFO by
+    default), with the time each item waited recorded per priority class.
+    """
+
+    def __init__(self, maxsize=0, policy=None):
+        self.policy = policy or FIFOPolicy()
+        self.served = {}
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self.heap = []
+        # ties (and the FIFO policy) keep arrival order
+        self.counter = itertools.count()
+
+    def _qsize(self):
+        return len(self.heap)
+
+    def _put(self, item):
+        now = time.monotonic()
+        heapq.heappush(self.heap, (self.policy.key(item, now), next(self.counter), now, item))
+
+    def _get(self):
+        _, _, queued_at, item = heapq.heappop(self.heap)
+        priority_class = self.policy.priority_class(item)
+        self.served[priority_class] = self.served.get(priority_class, 0) + 1
+        QUEUE_WAIT.observe(time.monotonic() - queued_at, priority_class=priority_class)
+        return item
+
+    def stats(self):
+        with self.mutex:
+            queued = {}
+            for _, _, _, item in self.heap:
+                priority_class = self.policy.priority_class(item)
+                queued[priority_class] = queued.get(priority_class, 0) + 1
+            return {'policy': self.policy.name, 'queued': queued, 'served': dict(self.served)}
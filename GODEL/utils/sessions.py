@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Server-side dialog sessions holding the token ids of every turn
+"""
+
+import uuid
+from array import array
+from threading import Lock
+
+from GODEL.utils.cache import LRUCache
+
+
+def session_bytes(session):
+    return sum(ids.itemsize * len(ids) for ids in session['turn_ids'])
+
+
+class SessionStore(object):
+    """
+    Dialog histories kept as one compact id array per turn, so a client only
+    sends its newest turn and only that turn is tokenized. Sessions are
+    evicted least recently used once they exceed `max_bytes`, or after `ttl`
+    seconds without a request. With `max_turns` only the latest turns of a
+    session are kept, and a session outgrowing `max_bytes` by itself loses
+    its oldest turns.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, ttl=1800, max_turns=None):
+        self.sessions = LRUCache(max_bytes, ttl=ttl, sizeof=session_bytes)
+        self.max_turns = max_turns
+        self.lock = Lock()
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def create(self, model=None):
+        session_id = uuid.uuid4().hex
+        self.sessions.put(session_id, {'model': model, 'turn_ids': []})
+        return session_id
+
+    def model(self, session_id):
+        session = self.sessions.get(session_id, count=False)
+        if session is None:
+            raise KeyError(session_id)
+        return session['model']
+
+    def append(self, session_id, turn_ids):
+        """
+        Add the ids of new turns and return the ids of the whole history as
+        lists, ready for `InputBuilder.build(turn_ids=...)`. Raises
+        ValueError when the new turns alone do not fit into the store.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise KeyError(session_id)
+            history = session['turn_ids'] + [array('i', ids) for ids in turn_ids]
+            if self.max_turns is not None:
+                history = history[-self.max_turns:]
+            # the cache would not store the session at all
+            while history and session_bytes({'turn_ids': history}) > self.sessions.max_bytes:
+                history.pop(0)
+            if len(history) < len(turn_ids):
+                raise ValueError('the turns do not fit into the session store')
+            # re-inserted rather than mutated so the size accounting and the
+            # idle timeout are refreshed
+            self.sessions.put(session_id, {'model': session['model'], 'turn_ids': history})
+        return [list(ids) for ids in history]
+
+    def truncate(self, session_id, num_turns):
+        """
+        Drop the turns after the first `num_turns`, e.g. when the request
+        that added them failed.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id, count=False)
+            if session is not None:
+                self.sessions.put(session_id, {'model': session['model'],
+                                               'turn_ids': session['turn_ids'][:num_turns]})
+
+    def delete(self, session_id):
+        return self.sessions.pop(session_id) is not None
+
+    def stats(self):
+        stats = self.sessions.stats()
+        stats['sessions'] = stats.pop('entries')
+        return stats
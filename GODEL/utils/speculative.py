@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Speculative greedy decoding with a small GODEL checkpoint as the draft model
+"""
+
+import time
+
+import torch
+from transformers import LogitsProcessorList
+
+from GODEL.utils.logits_processors import MinLengthProcessor, NoRepeatNGramProcessor
+
+
+def crop_past(past_key_values, length):
+    """
+    Keep the first `length` positions of the decoder self-attention cache
+    (the cross-attention cache does not depend on the decoded tokens).
+    """
+    return tuple((layer[0][:, :, :length], layer[1][:, :, :length]) + tuple(layer[2:])
+                 for layer in past_key_values)
+
+
+class SpeculativeDecoder(object):
+    """
+    The draft model proposes `num_speculative_tokens` tokens greedily, the
+    target model scores all of them in one decoder pass and keeps the
+    longest prefix that matches its own greedy choice, plus its own token at
+    the first mismatch. The output is the target's greedy output (up to
+    floating point differences between the one-pass and step-wise logits).
+    Sequences of a batch are decoded one after the other.
+    """
+
+    def __init__(self, model, draft_model, num_speculative_tokens=4):
+        self.model = model
+        self.draft_model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
+        self.config = model.config
+        self.reset_stats()
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def reset_stats(self):
+        self.proposed = 0
+        self.accepted = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def stats(self):
+        return {
+            'acceptance_rate': self.accepted / self.proposed if self.proposed else 0.0,
+            'tokens_per_s': self.tokens / self.seconds if self.seconds else 0.0,
+            'proposed': self.proposed,
+            'accepted': self.accepted,
+            'tokens': self.tokens,
+        }
+
+    @staticmethod
+    def supports(gen_kwargs):
+        # the repetition penalty is not applied to the drafted tokens
+        return (gen_kwargs.get('num_beams', 1) == 1 and not gen_kwargs.get('do_sample', False)
+                and gen_kwargs.get('repetition_penalty', 1.0) == 1.0)
+
+    @torch.no_grad()
+    def generate(self, input_ids, attention_mask=None, max_length=None, min_length=0,
+                 no_repeat_ngram_size=0, num_beams=1, do_sample=False, repetition_penalty=1.0, **kwargs):
+        if num_beams > 1 or do_sample or repetition_penalty != 1.0:
+            raise ValueError('Speculative decoding only supports greedy decoding without a repetition penalty')
+        config = self.config
+        max_length = max_length or config.max_length
+        if attention_mask is None:
+            attention_mask = (input_ids != config.pad_token_id).long()
+        logits_processor = LogitsProcessorList()
+        if min_length:
+            logits_processor.append(MinLengthProcessor(min_length, config.eos_token_id))
+        if no_repeat_ngram_size:
+            logits_processor.append(NoRepeatNGramProcessor(no_repeat_ngram_size))
+
+        start = time.perf_counter()
+        sequences = []
+        for row_ids, row_mask in zip(input_ids, attention_mask):
+            length = int(row_mask.sum())
+            sequences.append(self.generate_one(row_ids[None, :length], max_length, logits_processor))
+        self.seconds += time.perf_counter() - start
+
+        output = torch.full((len(sequences), max(len(s) for s in sequences)), config.pad_token_id,
+                            dtype=torch.long, device=input_ids.device)
+        for i, sequence in enumerate(sequences):
+            output[i, :len(sequence)] = torch.tensor(sequence, device=input_ids.device)
+        return output
+
+    def generate_one(self, input_ids, max_length, logits_processor):
+        config = self.config
+        encoder_outputs = self.model.get_encoder()(input_ids=input_ids, return_dict=True)
+        draft_encoder_outputs = self.draft_model.get_encoder()(input_ids=input_ids, return_dict=True)
+
+        tokens = [config.decoder_start_token_id]
+        past, past_length = None, 0
+        draft_past, draft_past_length = None, 0
+        while len(tokens) < max_length and tokens[-1] != config.eos_token_id:
+            k = min(self.num_speculative_tokens, max_length - len(tokens) - 1)
+
+            # draft k tokens, feeding the part of the prefix it has not seen yet
+            proposals = []
+            feed = tokens[draft_past_length:]
+            for _ in range(k):
+                outputs = self.draft_model(
+                    encoder_outputs=draft_encoder_outputs,
+                    decoder_input_ids=torch.tensor([feed], device=input_ids.device),
+                    past_key_values=draft_past,
+                    use_cache=True,
+                    return_dict=True,
+                )
+                draft_past = outputs.past_key_values
+                draft_past_length += len(feed)
+                prefix = torch.tensor([tokens + proposals], device=input_ids.device)
+                token = int(logits_processor(prefix, outputs.logits[:, -1, :]).argmax(-1))
+                proposals.append(token)
+                if token == config.eos_token_id:
+                    break
+                feed = [token]
+
+            # score the unseen prefix and every proposal in one target pass
+            feed = tokens[past_length:] + proposals
+            outputs = self.model(
+                encoder_outputs=encoder_outputs,
+                decoder_input_ids=torch.tensor([feed], device=input_ids.device),
+                past_key_values=past,
+                use_cache=True,
+                return_dict=True,
+            )
+            logits = outputs.logits[0, -len(proposals) - 1:, :]
+            accepted = 0
+            for i in range(len(proposals) + 1):
+                prefix = torch.tensor([tokens + proposals[:i]], device=input_ids.device)
+                token = int(logits_processor(prefix, logits[i:i + 1]).argmax(-1))
+                if i < len(proposals) and token == proposals[i]:
+                    accepted += 1
+                    continue
+                break
+            new_tokens = proposals[:accepted] + [token]
+
+            self.proposed += len(proposals)
+            self.accepted += accepted
+            if config.eos_token_id in new_tokens:
+                new_tokens = new_tokens[:new_tokens.index(config.eos_token_id) + 1]
+            new_tokens = new_tokens[:max_length - len(tokens)]
+            self.tokens += len(new_tokens)
+
+            # caches stay valid up to the last accepted proposal
+            valid_length = len(tokens) + accepted
+            tokens = tokens + new_tokens
+            past, past_length = crop_past(outputs.past_key_values, valid_length), valid_length
+            draft_past_length = min(draft_past_length, valid_length)
+            draft_past = crop_past(draft_past, draft_past_length) if draft_past is not None else None
+        return tokens
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Static-shape T5 decoding with a preallocated key/value cache
+"""
+
+import os
+from threading import Lock
+
+import torch
+from transformers import (
+    BeamSearchScorer,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+)
+
+from GODEL.utils.continuous_batching import pad_to
+from GODEL.utils.logits_processors import MinLengthProcessor, NoRepeatNGramProcessor
+
+
+def bucket(length, multiple):
+    return -(-length // multiple) * multiple
+
+
+def enable_compile_cache(cache_dir):
+    """
+    Keep inductor's compiled kernels and graphs in `cache_dir` so that a
+    restarted server reuses them instead of compiling again.
+    """
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.expanduser(cache_dir)
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+
+
+class StaticT5Decoder(object):
+    """
+    Greedy and beam search decoding for T5-style checkpoints (GODEL) that
+    re-implements the decoder step on top of the model's own modules:
+
+    - the self-attention key/value cache is allocated once for
+      `max_length` positions and written in place, attention always spans
+      all positions and a precomputed relative position bias + causal mask
+      hides the ones not decoded yet;
+    - cross-attention keys/values are projected once per request;
+    - with `compile=True` the step runs through `torch.compile`. Shapes
+      stay static by padding the batch to a power of two and the encoder
+      input to a multiple of `encoder_bucket`.
+
+    Outputs match `model.generate()` with the same settings.
+    """
+
+    def __init__(self, model, max_length=128, compile=False, encoder_bucket=128):
+        config = model.config
+        if config.model_type not in ('t5', 'mt5') or not config.is_encoder_decoder:
+            raise ValueError(f'Static decoding supports T5-style checkpoints, not {config.model_type}')
+        self.model = model
+        self.config = config
+        self.max_length = max_length
+        self.compile = compile
+        self.encoder_bucket = encoder_bucket if compile else 1
+        self.decoder = model.get_decoder()
+        self.num_heads = config.num_heads
+        self.head_dim = config.d_kv
+        self.scale = config.d_model ** -0.5 if config.tie_word_embeddings else 1.0
+        self.caches = {}
+        self.lock = Lock()
+
+        attention = self.decoder.block[0].layer[0].SelfAttention
+        dtype = next(model.parameters()).dtype
+        with torch.no_grad():
+            bias = attention.compute_bias(max_length, max_length, device=self.device).to(dtype)
+        causal = torch.ones(max_length, max_length, dtype=torch.bool, device=self.device).tril()
+        # (1, heads, query position, key position)
+        self.self_bias = bias.masked_fill(~causal, torch.finfo(dtype).min)
+
+        self.step_fn = self.step
+        if compile:
+            # torch >= 2.0 only, and slow to import
+            from torch import _dynamo
+
+            # one graph per (batch bucket, encoder bucket)
+            _dynamo.config.cache_size_limit = max(_dynamo.config.cache_size_limit, 64)
+            self.step_fn = torch.compile(self.step, dynamic=False)
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def supports(self, gen_kwargs):
+        return not gen_kwargs.get('do_sample', False) and gen_kwargs.get('max_length', 0) <= self.max_length
+
+    def get_cache(self, batch_size):
+        """
+        Self-attention key/value buffers for every layer, allocated once per
+        batch size and reused by later calls.
+        """
+        if batch_size not in self.caches:
+            shape = (self.config.num_decoder_layers, batch_size, self.num_heads, self.max_length, self.head_dim)
+            dtype = next(self.model.parameters()).dtype
+            self.caches[batch_size] = (torch.zeros(shape, dtype=dtype, device=self.device),
+                                       torch.zeros(shape, dtype=dtype, device=self.device))
+        return self.caches[batch_size]
+
+    def split_heads(self, states):
+        return states.view(states.shape[0], -1, self.num_heads, self.head_dim).transpose(1, 2)
+
+    def cross_cache(self, encoder_hidden_states):
+        keys, values = [], []
+        for block in self.decoder.block:
+            attention = block.layer[1].EncDecAttention
+            keys.append(self.split_heads(attention.k(encoder_hidden_states)))
+            values.append(self.split_heads(attention.v(encoder_hidden_states)))
+        return torch.stack(keys), torch.stack(values)
+
+    def step(self, input_ids, position, self_keys, self_values, cross_keys, cross_values, encoder_bias):
+        """
+        One decoder step for `input_ids` (batch, 1) at `position` (a 1-element
+        tensor), writing its keys/values into the caches. Returns the logits.
+        """
+        batch_size = input_ids.shape[0]
+        hidden = self.decoder.embed_tokens(input_ids)
+        self_bias = self.self_bias.index_select(2, position)
+
+        for i, block in enumerate(self.decoder.block):
+            layer = block.layer[0]
+            attention = layer.SelfAttention
+            normed = layer.layer_norm(hidden)
+            query = self.split_heads(attention.q(normed))
+            self_keys[i].index_copy_(2, position, self.split_heads(attention.k(normed)))
+            self_values[i].index_copy_(2, position, self.split_heads(attention.v(normed)))
+            scores = torch.matmul(query, self_keys[i].transpose(3, 2)) + self_bias
+            weights = torch.softmax(scores.float(), dim=-1).type_as(scores)
+            output = torch.matmul(weights, self_values[i]).transpose(1, 2).reshape(batch_size, 1, -1)
+            hidden = hidden + attention.o(output)
+
+            layer = block.layer[1]
+            attention = layer.EncDecAttention
+            query = self.split_heads(attention.q(layer.layer_norm(hidden)))
+            scores = torch.matmul(query, cross_keys[i].transpose(3, 2)) + encoder_bias
+            weights = torch.softmax(scores.float(), dim=-1).type_as(scores)
+            output = torch.matmul(weights, cross_values[i]).transpose(1, 2).reshape(batch_size, 1, -1)
+            hidden = hidden + attention.o(output)
+
+            hidden = block.layer[-1](hidden)
+
+        hidden = self.decoder.final_layer_norm(hidden)
+        return self.model.lm_head(hidden * self.scale)[:, -1, :]
+
+    def logits_processor(self, min_length=0, no_repeat_ngram_size=0, repetition_penalty=1.0):
+        processors = LogitsProcessorList()
+        if repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        if no_repeat_ngram_size:
+            processors.append(NoRepeatNGramProcessor(no_repeat_ngram_size))
+        if min_length:
+            processors.append(MinLengthProcessor(min_length, self.config.eos_token_id))
+        return processors
+
+    @torch.no_grad()
+    def generate(self, input_ids, attention_mask=None, max_length=None, min_length=0, no_repeat_ngram_size=0,
+                 num_beams=1, do_sample=False, repetition_penalty=1.0, **kwargs):
+        if do_sample:
+            raise ValueError('Static decoding supports greedy and beam search decoding')
+        config = self.config
+        max_length = max_length or self.max_length
+        if max_length > self.max_length:
+            raise ValueError(f'max_length {max_length} exceeds the preallocated cache ({self.max_length})')
+        if attention_mask is None:
+            attention_mask = (input_ids != config.pad_token_id).long()
+        logits_processor = self.logits_processor(min_length, no_repeat_ngram_size, repetition_penalty)
+
+        batch_size = input_ids.shape[0]
+        rows = batch_size * num_beams
+        padded_rows = 1 << (rows - 1).bit_length() if self.compile else rows
+        encoder_hidden_states = self.model.get_encoder()(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+        # the encoder runs unpadded, its output is padded to the bucket
+        length = bucket(input_ids.shape[1], self.encoder_bucket)
+        encoder_hidden_states = pad_to(encoder_hidden_states, 1, length)
+        encoder_mask = pad_to(attention_mask, 1, length)
+        # every beam of a request reads the same encoder output
+        encoder_hidden_states = pad_to(encoder_hidden_states.repeat_interleave(num_beams, dim=0), 0, padded_rows)
+        encoder_mask = pad_to(encoder_mask.repeat_interleave(num_beams, dim=0), 0, padded_rows)
+        dtype = encoder_hidden_states.dtype
+        encoder_bias = (1.0 - encoder_mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+        cross_keys, cross_values = self.cross_cache(encoder_hidden_states)
+
+        with self.lock:
+            self_keys, self_values = self.get_cache(padded_rows)
+            self_keys.zero_()
+            self_values.zero_()
+
+            def step(tokens, position):
+                # a fresh (padded_rows, 1) tensor keeps the strides static too
+                input_tokens = tokens.new_zeros((padded_rows, 1))
+                input_tokens[:rows, 0] = tokens[:, -1]
+                position = torch.tensor([position], device=self.device)
+                return self.step_fn(input_tokens, position, self_keys, self_values,
+                                    cross_keys, cross_values, encoder_bias)[:rows]
+
+            if num_beams == 1:
+                return self.greedy(step, batch_size, max_length, logits_processor)
+            return self.beam_search(step, batch_size, num_beams, max_length, logits_processor,
+                                    self_keys, self_values)
+
+    def greedy(self, step, batch_size, max_length, logits_processor):
+        config = self.config
+        tokens = torch.full((batch_size, 1), config.decoder_start_token_id, dtype=torch.long, device=self.device)
+        unfinished = torch.ones(batch_size, dtype=torch.long, device=self.device)
+        while tokens.shape[-1] < max_length:
+            scores = logits_processor(tokens, step(tokens, tokens.shape[-1] - 1))
+            next_tokens = torch.argmax(scores, dim=-1)
+            next_tokens = next_tokens * unfinished + config.pad_token_id * (1 - unfinished)
+            tokens = torch.cat([tokens, next_tokens[:, None]], dim=-1)
+            unfinished = unfinished.mul((next_tokens != config.eos_token_id).long())
+            if unfinished.max() == 0:
+                break
+        return tokens
+
+    def beam_search(self, step, batch_size, num_beams, max_length, logits_processor, self_keys, self_values):
+        config = self.config
+        # generation_config only exists since transformers 4.26, before that
+        # the defaults live on the model config
+        generation_config = getattr(self.model, 'generation_config', self.model.config)
+        beam_scorer = BeamSearchScorer(
+            batch_size=batch_size,
+            num_beams=num_beams,
+            device=self.device,
+            length_penalty=generation_config.length_penalty,
+            do_early_stopping=generation_config.early_stopping,
+            num_beam_hyps_to_keep=1,
+            max_length=max_length,
+        )
+        rows = batch_size * num_beams
+        tokens = torch.full((rows, 1), config.decoder_start_token_id, dtype=torch.long, device=self.device)
+        beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float, device=self.device)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view(-1)
+
+        while True:
+            logits = step(tokens, tokens.shape[-1] - 1)
+            scores = logits_processor(tokens, torch.log_softmax(logits, dim=-1))
+            scores = scores + beam_scores[:, None].expand_as(scores)
+            vocab_size = scores.shape[-1]
+            scores = scores.view(batch_size, num_beams * vocab_size)
+            scores, next_tokens = torch.topk(scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+            next_indices = torch.div(next_tokens, vocab_size, rounding_mode='floor')
+            next_tokens = next_tokens % vocab_size
+
+            beam_outputs = beam_scorer.process(
+                tokens, scores, next_tokens, next_indices,
+                pad_token_id=config.pad_token_id, eos_token_id=config.eos_token_id)
+            beam_scores = beam_outputs['next_beam_scores']
+            beam_idx = beam_outputs['next_beam_indices']
+            tokens = torch.cat([tokens[beam_idx, :], beam_outputs['next_beam_tokens'].unsqueeze(-1)], dim=-1)
+            # beams only move within their request, whose cross-attention
+            # cache is the same for all of them
+            self_keys[:, :rows] = self_keys[:, beam_idx]
+            self_values[:, :rows] = self_values[:, beam_idx]
+            if beam_scorer.is_done or tokens.shape[-1] >= max_length:
+                break
+
+        return beam_scorer.finalize(
+            tokens, beam_scores, next_tokens, next_indices,
+            pad_token_id=config.pad_token_id, eos_token_id=config.eos_token_id, max_length=max_length,
+        )['sequences']
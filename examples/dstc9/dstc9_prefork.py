@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Multi-process CPU serving of dstc9_server.py
+
+    python dstc9_prefork.py --num_workers 8
+
+loads the model once, then forks `num_workers` processes pinned to disjoint
+core sets that share the weights copy-on-write and accept on one socket.
+Caches, sessions and /metrics are per process. /admin/reload is refused:
+a reload would only reach the worker that accepted the request, and it
+would lose the weights shared with the others, so restart instead.
+"""
+
+import logging
+import os
+
+import fire
+
+import dstc9_server
+from GODEL.utils.prefork import PreforkServer
+
+
+def main(num_workers=None, host='127.0.0.1', port=8082):
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    # forked children cannot use a CUDA context created by the parent, so
+    # the model is kept on the CPU and no GPU is visible to torch
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    dstc9_server.load_server(device='cpu', n_gpu=0, worker_devices=[])
+    PreforkServer(dstc9_server.app, host=host, port=port, num_workers=num_workers,
+                  start_worker=start_worker).serve()
+
+
+def start_worker(index):
+    dstc9_server.reloadable = False
+    dstc9_server.start_workers()
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -3,11 +3,24 @@
 #  Copyright (c) Microsoft Corporation.
 #  Licensed under the MIT license.
 
-from threading import Thread
-from queue import Queue
-from flask import Flask, request, jsonify
+from concurrent.futures import TimeoutError as FutureTimeout
+from functools import partial
+from threading import BoundedSemaphore, Event, Lock, Thread
+from queue import Full
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
+import hmac
+import importlib
+import json
+import logging
 import os
+import time
+
+from GODEL.utils.batching import DeadlineExceeded, MicroBatcher, PipelinedBatcher
+from GODEL.utils.cache import ResponseCache
+from GODEL.utils.metrics import CONTENT_TYPE, metrics
+from GODEL.utils.scheduling import SchedulingQueue, get_policy
+from GODEL.utils.sessions import SessionStore
 
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
@@ -15,48 +28,694 @@ app = Flask(__name__)
 CORS(app)
 
 
-rgi_queue = Queue(maxsize=0)
-rgo_queue = Queue(maxsize=0)
+# bounded by args.max_queue_size and ordered by args.scheduling once the
+# server is loaded
+rgi_queue = SchedulingQueue()
+batcher = None
+engine = None
+response_cache = None
+sessions = None
+# GODEL.server, imported by the loader thread so HTTP is up before torch is
+server = None
+ready = Event()
 
 global_counter = 0
+counter_lock = Lock()
+bulk_jobs = None
+stream_slots = None
+# one hot reload at a time, its progress is reported by /admin/reload;
+# not available in the processes forked by dstc9_prefork.py
+reloading = Lock()
+reload_status = {'state': 'idle'}
+reloadable = True
+
+logger = logging.getLogger(__name__)
+
+metrics.gauge('godel_queue_depth', 'Requests waiting for a generation worker',
+              function=lambda: rgi_queue.qsize() + (engine.queue.qsize() if engine is not None else 0))
+metrics.gauge('godel_running_sequences', 'Sequences in the continuous batching engine',
+              function=lambda: len(engine.running) if engine is not None else 0)
+REQUEST_SECONDS = metrics.histogram('godel_request_seconds', 'Latency of /generate requests that were generated',
+                                    labelnames=('priority_class',))
+
+
+class InvalidRequest(ValueError):
+    pass
+
+
+def not_ready():
+    return jsonify({'status': 'loading'}), 503, {'Retry-After': '5'}
+
+
+def overloaded():
+    return jsonify({'error': 'server overloaded'}), 503, {'Retry-After': '1'}
+
+
+def wait(future, deadline, cancel):
+    """
+    Wait for a submitted request until its deadline, then `cancel()` it so
+    it is dropped from the queue or stops taking part in decoding.
+    """
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FutureTimeout:
+        cancel()
+        raise DeadlineExceeded()
+
+
+def invalid_request(in_request):
+    """
+    Why `in_request` cannot be generated for, None when it can. Checked
+    before queueing, a bad request would otherwise fail its whole batch.
+    """
+    if not isinstance(in_request, dict):
+        return 'the request must be a JSON object'
+    msg = in_request.get('msg')
+    if not isinstance(msg, list) or not all(isinstance(turn, str) for turn in msg):
+        return '"msg" must be a list of strings'
+    if 'knowledge' in in_request:
+        if not isinstance(in_request['knowledge'], str):
+            return '"knowledge" must be a string'
+    elif 'knowledge_ids' not in in_request and not server.has_retrieval():
+        # without a knowledge store to retrieve from, one of them is needed
+        return '"knowledge" or "knowledge_ids" is required'
+    if 'knowledge_ids' in in_request:
+        knowledge_ids = in_request['knowledge_ids']
+        if not isinstance(knowledge_ids, list) or not all(isinstance(key, str) for key in knowledge_ids):
+            return '"knowledge_ids" must be a list of strings'
+        if server.knowledge_store is None:
+            return '"knowledge_ids" needs a knowledge store, the server has none'
+    if not isinstance(in_request.get('params') or {}, dict):
+        return '"params" must be an object'
+    if not isinstance(in_request.get('model', ''), str):
+        return '"model" must be a string'
+    if not isinstance(in_request.get('session_id', ''), str):
+        return '"session_id" must be a string'
+    timeout = in_request.get('timeout', server.args.request_timeout)
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) \
+            or not 0 < timeout <= server.args.max_request_timeout:
+        return '"timeout" must be a positive number of seconds, at most %s' % server.args.max_request_timeout
+    priority = in_request.get('priority', 'interactive')
+    if not isinstance(priority, str) or priority not in server.args.priority_delays:
+        return '"priority" must be one of %s' % ', '.join(sorted(server.args.priority_delays))
+    return server.invalid_params(in_request.get('params'))
+
+
+def unknown_knowledge(in_request):
+    """
+    The `knowledge_ids` of a (valid) request missing from the knowledge store.
+    """
+    return [key for key in in_request.get('knowledge_ids', []) if key not in server.knowledge_store]
+
+
+def priority_class(in_request):
+    return in_request.get('priority', 'interactive')
+
+
+def request_cost(in_request):
+    """
+    Rough cost of a request in decoder steps: every beam decodes up to
+    `max_length` tokens, the encoder input counts much less as it is
+    processed in parallel. Texts are not tokenized for this, ~4 characters
+    make a token.
+    """
+    gen_kwargs = server.get_gen_kwargs(in_request.get('params'))
+    if 'turn_ids' in in_request:
+        input_tokens = sum(len(ids) for ids in in_request['turn_ids'])
+    else:
+        input_tokens = len(' EOS '.join(in_request.get('msg', []))) / 4
+    if 'knowledge_ids' in in_request and server.knowledge_store is not None:
+        input_tokens += sum(len(server.knowledge_store.token_ids(key)) for key in in_request['knowledge_ids']
+                            if key in server.knowledge_store)
+    else:
+        input_tokens += len(in_request.get('knowledge', '')) / 4
+    return gen_kwargs['max_length'] * gen_kwargs.get('num_beams', 1) + input_tokens / 8
+
+
+def sequence_cost(sequence):
+    return sequence.max_length + len(sequence.input_ids) / 8
+
+
+def make_policy(cost, get_priority_class):
+    args = server.args
+    return get_policy(args.scheduling, cost=cost, priority_class=get_priority_class,
+                      delays=args.priority_delays, cost_per_second=args.sjf_cost_per_second)
+
+
+def submit(request_id, in_request, deadline):
+    """
+    Generate through the continuous batching engine when it serves the
+    request, through the micro-batcher otherwise.
+    """
+    if engine is not None and in_request.get('model') in (None, server.DEFAULT_MODEL):
+        gen_kwargs = server.get_gen_kwargs(in_request.get('params'))
+        if engine.supports(gen_kwargs):
+            future = engine.submit(encode_request(in_request), gen_kwargs, deadline=deadline,
+                                   priority_class=priority_class(in_request))
+            return {'response': wait(future, deadline, partial(engine.cancel, future))}
+    future = batcher.submit(request_id, in_request, deadline=deadline)
+    return wait(future, deadline, partial(batcher.cancel, request_id))
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/ready', methods=['GET'])
+def readiness():
+    if not ready.is_set():
+        return not_ready()
+    return jsonify({'status': 'ready'})
 
 
 @app.route('/generate', methods=['GET', 'POST'])
 def generate_queue():
-    global global_counter, rgi_queue, rgo_queue
+    global global_counter, batcher, response_cache
+    if not ready.is_set():
+        return not_ready()
     try:
         in_request = request.json
-        print(in_request)
+        logger.debug(in_request)
     except:
         return "invalid input: "
-    global_counter += 1
-    rgi_queue.put((global_counter, in_request))
-    output = rgo_queue.get()
-    rgo_queue.task_done()
+    error = invalid_request(in_request)
+    if error:
+        return jsonify({'error': error}), 400
+    missing = unknown_knowledge(in_request)
+    if missing:
+        return jsonify({'error': 'unknown knowledge %s' % ', '.join(missing)}), 404
+    error = server.unsupported_params(in_request.get('params'))
+    if error:
+        return jsonify({'error': error}), 400
+    if in_request.get('model') not in (None, server.DEFAULT_MODEL):
+        if in_request['model'] not in server.registry:
+            return jsonify({'error': 'unknown model %s' % in_request['model']}), 404
+        # a cold checkpoint is loaded on this request's thread, not by the
+        # generation worker every queued request is waiting on
+        server.get_model(in_request['model'])
+    start = time.perf_counter()
+    with counter_lock:
+        global_counter += 1
+        request_id = global_counter
+
+    deadline = time.monotonic() + float(in_request.get('timeout', server.args.request_timeout))
+    add_retrieved_knowledge(in_request)
+
+    def compute():
+        output = submit(request_id, in_request, deadline)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, priority_class=priority_class(in_request))
+        return output
+
+    if in_request.get('session') or 'session_id' in in_request:
+        return generate_in_session(in_request, compute)
+
+    params = in_request.get('params')
+    try:
+        if response_cache.is_cacheable(params):
+            # responses of batches still running on the weights replaced by a
+            # hot reload are stored under the old revision
+            key = ResponseCache.key(' EOS '.join(in_request['msg']), in_request.get('knowledge', ''),
+                                    dict(params or {}, model=in_request.get('model'),
+                                         revision=server.model_revision),
+                                    knowledge_ids=in_request.get('knowledge_ids'))
+            output = response_cache.get_or_compute(
+                key, compute, timeout=max(0, deadline - time.monotonic()))
+        else:
+            output = compute()
+    except Full:
+        return overloaded()
+    except (DeadlineExceeded, FutureTimeout):
+        return jsonify({'error': 'deadline exceeded'}), 504
+    except InvalidRequest as e:
+        return jsonify({'error': 'invalid request: %s' % e}), 400
     return jsonify(output)
 
 
-def generate_for_queue(in_queue, out_queue):
-    while True:
-        _, in_request = in_queue.get()
-        context = ' EOS '.join(in_request['msg'])
+def generate_in_session(in_request, compute):
+    """
+    `msg` holds only the new turns of the session `session_id` (a new
+    session is started when the request has `"session": true` instead).
+    The history is assembled from the ids kept in the session store and the
+    generated response is added to it as the next turn.
+    """
+    session_id = in_request.get('session_id')
+    try:
+        if session_id is None:
+            session_id = sessions.create(in_request.get('model'))
+        model_name = sessions.model(session_id)
+    except KeyError:
+        return jsonify({'error': 'unknown session %s' % session_id}), 404
+    if in_request.get('model', model_name) != model_name:
+        return jsonify({'error': 'session %s uses model %s' % (session_id, model_name)}), 400
+
+    _, _, builder = server.get_model(model_name)
+    try:
+        in_request['turn_ids'] = sessions.append(session_id, builder.encode_turns(in_request['msg']))
+    except KeyError:
+        return jsonify({'error': 'unknown session %s' % session_id}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    num_turns = len(in_request['turn_ids'])
+
+    try:
+        output = compute()
+    except Full:
+        sessions.truncate(session_id, num_turns - len(in_request['msg']))
+        return overloaded()
+    except (DeadlineExceeded, FutureTimeout):
+        sessions.truncate(session_id, num_turns - len(in_request['msg']))
+        return jsonify({'error': 'deadline exceeded'}), 504
+    except InvalidRequest as e:
+        sessions.truncate(session_id, num_turns - len(in_request['msg']))
+        return jsonify({'error': 'invalid request: %s' % e}), 400
+    sessions.append(session_id, builder.encode_turns([output['response']]))
+    return jsonify(dict(output, session_id=session_id))
+
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def end_session(session_id):
+    if not ready.is_set():
+        return not_ready()
+    if not sessions.delete(session_id):
+        return jsonify({'error': 'unknown session %s' % session_id}), 404
+    return jsonify({'status': 'deleted'})
+
+
+def is_admin():
+    token = server.args.admin_token
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)
+
+
+@app.route('/admin/reload', methods=['GET', 'POST'])
+def admin_reload():
+    """
+    POST {"path": CHECKPOINT_DIR} loads a `save_pretrained` directory (the
+    current one by default) in the background, warms it up and swaps it in
+    between batches; GET reports the progress of the last reload.
+    """
+    global reload_status
+    if not ready.is_set():
+        return not_ready()
+    if not is_admin():
+        return jsonify({'error': 'unauthorized'}), 401
+    if not reloadable:
+        return jsonify({'error': 'hot reload is not supported by forked workers, restart the server'}), 501
+    if request.method == 'GET':
+        return jsonify(reload_status)
+    path = (request.get_json(silent=True) or {}).get('path') or server.args.model_name_or_path
+    if not os.path.isdir(path):
+        return jsonify({'error': 'not a checkpoint directory: %s' % path}), 400
+    if not reloading.acquire(blocking=False):
+        return jsonify(dict(reload_status, error='a reload is already running')), 409
+    reload_status = {'state': 'loading', 'path': path, 'started': time.time()}
+    reloader = Thread(target=reload_checkpoint, args=(path,))
+    reloader.daemon = True
+    reloader.start()
+    return jsonify(reload_status), 202
+
+
+def reload_checkpoint(path):
+    """
+    Swap the checkpoint `path` in as the main model, then wait for the
+    batches still running on the old weights so they can be freed.
+    """
+    try:
+        timings, old_model = server.reload_model(path)
+        if engine is not None:
+            engine.swap_model(server.model)
+        # cached responses came from the old weights, new requests already
+        # look them up under the new revision
+        response_cache.clear()
+        reload_status.update(state='freeing', timings=timings)
+        reload_status.update(state='done', old_model_freed=server.free_model(old_model), finished=time.time())
+    except Exception as e:
+        logger.exception('Reloading %s failed', path)
+        reload_status.update(state='failed', error=str(e), finished=time.time())
+    finally:
+        reloading.release()
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    out = {'cache': response_cache.stats(), 'models': server.registry.stats(), 'sessions': sessions.stats(),
+           'scheduler': rgi_queue.stats()}
+    if isinstance(batcher, PipelinedBatcher):
+        out['pipeline'] = batcher.stats()
+    if server.encoder_cache is not None:
+        out['encoder_cache'] = server.encoder_cache.stats()
+    if server.speculative is not None:
+        out['speculative'] = server.speculative.stats()
+    if engine is not None:
+        out['engine'] = dict(engine.stats(), scheduler=engine.queue.stats())
+    return jsonify(out)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.expose(), content_type=CONTENT_TYPE)
+
+
+@app.route('/generate_stream', methods=['POST'])
+def generate_stream_queue():
+    if not ready.is_set():
+        return not_ready()
+    try:
+        in_request = request.json
+        logger.debug(in_request)
+    except:
+        return "invalid input: "
+    if server.args.backend == 'onnx':
+        return jsonify({'error': 'streaming is not supported by the onnx backend'}), 400
+    error = invalid_request(in_request)
+    if error:
+        return jsonify({'error': error}), 400
+    missing = unknown_knowledge(in_request)
+    if missing:
+        return jsonify({'error': 'unknown knowledge %s' % ', '.join(missing)}), 404
+    context = ' EOS '.join(in_request['msg'])
+    add_retrieved_knowledge(in_request)
+    if 'knowledge_ids' in in_request:
+        knowledge = server.knowledge_store.text(in_request['knowledge_ids'])
+    else:
         knowledge = in_request['knowledge']
-        response = generate(context, knowledge)
 
-        res = {}
-        res['response'] = response[0]
-        out_queue.put(res)
-        in_queue.task_done()
+    if not stream_slots.acquire(blocking=False):
+        return overloaded()
+    deadline = time.monotonic() + float(in_request.get('timeout', server.args.request_timeout))
 
+    def events():
+        response = ''
+        tokens = server.generate_stream(context, knowledge, stop=lambda: time.monotonic() > deadline)
+        try:
+            for token in tokens:
+                response += token
+                yield 'data: %s\n\n' % json.dumps({'token': token})
+            if time.monotonic() > deadline:
+                yield 'event: error\ndata: %s\n\n' % json.dumps({'error': 'deadline exceeded', 'response': response})
+            else:
+                yield 'event: done\ndata: %s\n\n' % json.dumps({'response': response})
+        except GeneratorExit:
+            # the client went away, stop decoding instead of finishing the reply
+            logger.debug('stream cancelled after %d characters', len(response))
+            raise
+        finally:
+            tokens.close()
 
-if __name__ == "__main__":
+    response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # also runs when the client leaves before the first event
+    response.call_on_close(stream_slots.release)
+    return response
+
+
+@app.route('/generate_batch', methods=['POST'])
+def generate_batch_queue():
+    """
+    Bulk generation for offline callers: a JSON list of {msg, knowledge,
+    params} items (or {"items": [...]}), or a JSONL body / file upload.
+    Results are streamed back as JSON lines in input order.
+    """
+    if not ready.is_set():
+        return not_ready()
+    try:
+        in_requests = read_bulk_request()
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'error': 'invalid input: %s' % e}), 400
+    batch_size = request.args.get('batch_size', server.args.bulk_batch_size, type=int)
+    if not bulk_jobs.acquire(blocking=False):
+        return overloaded()
+
+    def lines():
+        results, next_index = {}, 0
+        try:
+            for index, result in generate_bulk(in_requests, batch_size):
+                results[index] = result
+                # items finish in length order, release them in input order
+                while next_index in results:
+                    yield json.dumps(dict(results.pop(next_index), index=next_index)) + '\n'
+                    next_index += 1
+        finally:
+            bulk_jobs.release()
+
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+
+
+def read_bulk_request():
+    if request.files:
+        body = next(iter(request.files.values())).read().decode('utf-8')
+    elif request.is_json:
+        in_requests = request.get_json()
+        return in_requests['items'] if isinstance(in_requests, dict) else list(in_requests)
+    else:
+        body = request.get_data(as_text=True)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def generate_bulk(in_requests, batch_size):
+    """
+    Yield (index, result) for every item. Items sharing a checkpoint and
+    decoding params are sorted by input length and generated `batch_size`
+    at a time, so each padded batch holds inputs of similar length.
+    """
+    groups = {}
+    for i, in_request in enumerate(in_requests):
+        # a bad item only fails itself, the stream goes on
+        error = invalid_request(in_request)
+        if error:
+            yield i, {'error': 'invalid item: %s' % error}
+            continue
+        missing = unknown_knowledge(in_request)
+        if missing:
+            yield i, {'error': 'unknown knowledge %s' % ', '.join(missing)}
+            continue
+        key = json.dumps([in_request.get('model'), in_request.get('params') or {}], sort_keys=True)
+        groups.setdefault(key, []).append(i)
+
+    for indices in groups.values():
+        name = in_requests[indices[0]].get('model')
+        params = in_requests[indices[0]].get('params')
+        try:
+            group_model, group_tokenizer, builder = server.get_model(name)
+        except KeyError:
+            for i in indices:
+                yield i, {'error': 'unknown model %s' % name}
+            continue
+        except Exception as e:
+            logger.exception('Loading model %s failed', name)
+            for i in indices:
+                yield i, {'error': 'loading model %s failed: %s' % (name, e)}
+            continue
+        error = server.unsupported_params(params)
+        if error:
+            for i in indices:
+                yield i, {'error': error}
+            continue
+
+        try:
+            add_retrieved_knowledge(*[in_requests[i] for i in indices])
+        except Exception as e:
+            logger.exception('Bulk retrieval failed')
+            for i in indices:
+                yield i, {'error': 'retrieval failed: %s' % e}
+            continue
+        encoded = []
+        for i in indices:
+            try:
+                encoded.append((i, encode_request(in_requests[i], builder=builder)))
+            except Exception as e:
+                yield i, {'error': 'invalid item: %s' % e}
+        encoded.sort(key=lambda item: len(item[1]))
 
-    from DialoGLM.server import *
+        for start in range(0, len(encoded), batch_size):
+            batch = encoded[start:start + batch_size]
+            try:
+                responses = server.generate_ids([input_ids for _, input_ids in batch], params=params,
+                                                replica=group_model, replica_tokenizer=group_tokenizer)
+            except Exception as e:
+                # e.g. invalid params: only the items of this batch fail, the stream goes on
+                logger.exception('Bulk generation failed')
+                for i, _ in batch:
+                    yield i, {'error': 'generation failed: %s' % e}
+                continue
+            for (i, _), response in zip(batch, responses):
+                yield i, {'response': response}
+
+
+def add_retrieved_knowledge(*in_requests):
+    """
+    Requests sending neither `knowledge` nor `knowledge_ids` are grounded
+    on documents retrieved from the server's knowledge store.
+    """
+    if not server.has_retrieval():
+        return
+    in_requests = [in_request for in_request in in_requests
+                   if 'msg' in in_request and 'knowledge' not in in_request and 'knowledge_ids' not in in_request]
+    if in_requests:
+        retrieved = server.retrieve_knowledge_batch([in_request['msg'] for in_request in in_requests])
+        for in_request, keys in zip(in_requests, retrieved):
+            in_request['knowledge_ids'] = keys
+
+
+def encode_request(in_request, builder=None):
+    builder = builder or server.input_builder
+    if 'turn_ids' in in_request:
+        # session requests carry their already tokenized history
+        if 'knowledge_ids' in in_request:
+            return server.encode_with_knowledge_ids(None, in_request['knowledge_ids'], builder=builder,
+                                                    turn_ids=in_request['turn_ids'])
+        return builder.build(turn_ids=in_request['turn_ids'], knowledge=in_request['knowledge'])
+    context = ' EOS '.join(in_request['msg'])
+    if 'knowledge_ids' in in_request:
+        return server.encode_with_knowledge_ids(context, in_request['knowledge_ids'], builder=builder)
+    return server.encode_batch([context], [in_request['knowledge']], builder=builder)[0]
+
+
+def prepare_batch(in_requests):
+    """
+    Tokenizer stage: group the requests by checkpoint and decoding params
+    (only those can share a generate call) and pad each group's input ids.
+    """
+    groups = {}
+    for i, in_request in enumerate(in_requests):
+        key = json.dumps([in_request.get('model'), in_request.get('params') or {}], sort_keys=True)
+        groups.setdefault(key, []).append(i)
+
+    jobs = []
+    # request index -> exception, a request that cannot be encoded only
+    # fails itself
+    errors = {}
+    for indices in groups.values():
+        name = in_requests[indices[0]].get('model')
+        group_model, group_tokenizer, builder = server.get_model(name)
+        with server.STAGE_SECONDS.time(stage='tokenize'):
+            encoded, input_ids = [], []
+            for i in indices:
+                try:
+                    input_ids.append(encode_request(in_requests[i], builder=builder))
+                    encoded.append(i)
+                except (KeyError, TypeError, AttributeError, ValueError) as e:
+                    errors[i] = InvalidRequest(str(e))
+            if not encoded:
+                continue
+            encodings = server.pad_inputs(input_ids, group_tokenizer)
+        jobs.append({'indices': encoded, 'name': name, 'params': in_requests[indices[0]].get('params'),
+                     'model': group_model, 'tokenizer': group_tokenizer, 'encodings': encodings})
+    return len(in_requests), jobs, errors
+
+
+def execute_batch(batch, worker=None, stop=None):
+    """
+    Model stage: generate the output ids of every group.
+    """
+    # the replica of worker number `worker` serves the main model, looked up
+    # once per batch so a hot reload never swaps weights under a batch
+    replica = server.get_replica(worker)
+    for job in batch[1]:
+        group_replica = replica if job['name'] in (None, server.DEFAULT_MODEL) else job['model']
+        job['output_ids'], job['decode_seconds'] = server.run_generation(
+            job['encodings'], params=job['params'], replica=group_replica, stop=stop)
+    return batch
+
+
+def finish_batch(batch):
+    """
+    Detokenizer stage: one response (or exception) per request, in
+    request order.
+    """
+    size, jobs, errors = batch
+    outputs = [None] * size
+    for i, error in errors.items():
+        outputs[i] = error
+    for job in jobs:
+        responses = server.decode_outputs(job['output_ids'], job['encodings'], job['decode_seconds'],
+                                          job['tokenizer'])
+        for i, response in zip(job['indices'], responses):
+            res = {}
+            res['response'] = response
+            outputs[i] = res
+    return outputs
+
+
+def generate_for_batch(in_requests, worker=None, stop=None):
+    return finish_batch(execute_batch(prepare_batch(in_requests), worker=worker, stop=stop))
+
+
+def load_server(**overrides):
+    """
+    Import GODEL.server and load the model; `overrides` replace server args
+    set below (e.g. by launchers that need a given device).
+    """
+    global server
+
+    server = importlib.import_module('GODEL.server')
+    args = server.args
     # replace the path with your trained checkpoint
     args.model_name_or_path = 't5-base'
-    main()
+    # args.knowledge_path = 'data/knowledge.json'
+    # args.retrieval_index_dir = 'data/knowledge_bm25'
+    # args.dense_index_dir = 'data/knowledge_dense'
+    # args.dense_model_name_or_path = 'sentence-transformers/all-MiniLM-L6-v2'
+    # args.checkpoints = {'dstc9': 'path/to/dstc9_ckpt', 'multiwoz': 'path/to/multiwoz_ckpt'}
+    # args.max_model_bytes = 8 * 2 ** 30
+    args.update(overrides)
+    server.main()
+
+
+def start_workers():
+    """
+    Queue, caches and generation threads of one serving process (started
+    after the fork when running under dstc9_prefork.py).
+    """
+    global batcher, engine, response_cache, rgi_queue, sessions, bulk_jobs, stream_slots
 
-    worker = Thread(target=generate_for_queue, args=(rgi_queue, rgo_queue,))
-    worker.setDaemon(True)
-    worker.start()
-    app.run(port=8082)
+    args = server.args
+    bulk_jobs = BoundedSemaphore(args.max_bulk_jobs)
+    stream_slots = BoundedSemaphore(args.max_streams)
+    rgi_queue = SchedulingQueue(maxsize=args.max_queue_size,
+                                policy=make_policy(lambda item: request_cost(item[1]),
+                                                   lambda item: priority_class(item[1])))
+    response_cache = ResponseCache(max_bytes=args.cache_max_bytes, ttl=args.cache_ttl,
+                                   cache_sampling=args.cache_sampling)
+    sessions = SessionStore(max_bytes=args.session_max_bytes, ttl=args.session_ttl,
+                            max_turns=args.session_max_turns)
+    server.load_replicas()
+    if args.pipeline:
+        batcher = PipelinedBatcher(rgi_queue, prepare_batch, execute_batch, finish_batch,
+                                   max_batch_size=args.max_batch_size,
+                                   max_wait_ms=args.max_wait_ms,
+                                   queue_size=args.pipeline_queue_size,
+                                   num_prepare_threads=args.tokenizer_threads,
+                                   num_finish_threads=args.detokenizer_threads)
+        batcher.start([partial(execute_batch, worker=i) for i in range(args.num_workers)])
+    else:
+        batcher = MicroBatcher(rgi_queue, generate_for_batch,
+                               max_batch_size=args.max_batch_size,
+                               max_wait_ms=args.max_wait_ms)
+        batcher.start([partial(generate_for_batch, worker=i) for i in range(args.num_workers)])
+    if args.continuous_batching:
+        # imports torch, which is kept off the HTTP thread's startup
+        from GODEL.utils.continuous_batching import ContinuousBatchingEngine
+        engine = ContinuousBatchingEngine(server.model, server.tokenizer, max_batch_size=args.max_batch_size,
+                                          max_queue_size=args.max_queue_size,
+                                          policy=make_policy(sequence_cost, lambda sequence: sequence.priority_class))
+        engine.start()
+    ready.set()
+
+
+def load():
+    load_server()
+    start_workers()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    # serve /health right away, /ready and /generate once the model is loaded
+    loader = Thread(target=load)
+    loader.daemon = True
+    loader.start()
+    app.run(port=8082, threaded=True)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Fixtures serving a tiny randomly initialized T5, so the tests run on CPU
+in seconds without downloading a checkpoint
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'examples', 'dstc9'))
+
+
+@pytest.fixture(scope='session')
+def tiny_checkpoints(tmp_path_factory):
+    """
+    Paths of a 2-layer model and a 1-layer draft model sharing a
+    sentencepiece-style vocabulary trained on the repo's README.
+    """
+    import torch
+    from tokenizers import SentencePieceUnigramTokenizer
+    from tokenizers.processors import TemplateProcessing
+    from transformers import T5Config, T5ForConditionalGeneration, T5TokenizerFast
+
+    root = tmp_path_factory.mktemp('tiny')
+    spm = SentencePieceUnigramTokenizer()
+    with open(os.path.join(ROOT, 'README.md'), encoding='utf-8') as f:
+        spm.train_from_iterator(f.read().splitlines(), vocab_size=500,
+                                special_tokens=['<pad>', '</s>', '<unk>'], unk_token='<unk>')
+    spm.post_processor = TemplateProcessing(single='$A </s>', pair='$A </s> $B </s>',
+                                            special_tokens=[('</s>', 1)])
+    tokenizer = T5TokenizerFast(tokenizer_object=spm, extra_ids=0)
+
+    torch.manual_seed(0)
+    paths = {}
+    for name, num_layers in [('model', 2), ('draft', 1)]:
+        config = T5Config(vocab_size=len(tokenizer), d_model=32, d_ff=64, d_kv=8, num_heads=4,
+                          num_layers=num_layers, num_decoder_layers=num_layers,
+                          decoder_start_token_id=0, pad_token_id=0, eos_token_id=1)
+        paths[name] = str(root / name)
+        T5ForConditionalGeneration(config).save_pretrained(paths[name])
+        tokenizer.save_pretrained(paths[name])
+    return paths
+
+
+@pytest.fixture(scope='session')
+def tiny_server(tiny_checkpoints):
+    """
+    GODEL.server loaded with the tiny model, through dstc9_server like the
+    example server does.
+    """
+    import dstc9_server
+
+    dstc9_server.load_server(model_name_or_path=tiny_checkpoints['model'], device='cpu', warmup=False)
+    return dstc9_server.server
+
+
+@pytest.fixture(scope='session')
+def client(tiny_server):
+    import dstc9_server
+
+    dstc9_server.start_workers()
+    return dstc9_server.app.test_client()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Cancellation, deadlines and admission control of the micro-batcher
+"""
+
+import time
+from concurrent.futures import CancelledError
+from queue import Full, Queue
+from threading import Event
+
+import pytest
+
+from GODEL.utils.batching import DeadlineExceeded, MicroBatcher
+
+
+def echo_batcher(**kwargs):
+    seen = []
+
+    def batch_fn(payloads, stop=None):
+        seen.extend(payloads)
+        return payloads
+
+    return MicroBatcher(Queue(**kwargs), batch_fn), seen
+
+
+def test_cancelled_request_is_not_generated():
+    batcher, seen = echo_batcher()
+    cancelled = batcher.submit(1, 'cancelled')
+    kept = batcher.submit(2, 'kept')
+    batcher.cancel(1)
+    batcher.start()
+
+    assert kept.result(timeout=10) == 'kept'
+    with pytest.raises(CancelledError):
+        cancelled.result(timeout=10)
+    batcher.in_queue.join()
+    assert seen == ['kept']
+    assert batcher.pending == {} and batcher.abandoned == set()
+
+
+def test_expired_request_is_not_generated():
+    batcher, seen = echo_batcher()
+    expired = batcher.submit(1, 'expired', deadline=time.monotonic() - 1)
+    kept = batcher.submit(2, 'kept', deadline=time.monotonic() + 60)
+    batcher.start()
+
+    assert kept.result(timeout=10) == 'kept'
+    with pytest.raises(DeadlineExceeded):
+        expired.result(timeout=10)
+    batcher.in_queue.join()
+    assert seen == ['kept']
+    assert batcher.pending == {}
+
+
+def test_running_batch_stops_once_abandoned():
+    running, stopped = Event(), Event()
+
+    def batch_fn(payloads, stop=None):
+        running.set()
+        while not stop():
+            time.sleep(0.01)
+        stopped.set()
+        return payloads
+
+    batcher = MicroBatcher(Queue(), batch_fn)
+    batcher.start()
+    batcher.submit(1, 'payload')
+    assert running.wait(timeout=10)
+    batcher.cancel(1)
+    assert stopped.wait(timeout=10)
+    batcher.in_queue.join()
+    assert batcher.pending == {}
+
+
+def test_failed_request_only_fails_itself():
+    batcher = MicroBatcher(Queue(), lambda payloads, stop=None: [
+        ValueError(payload) if payload == 'bad' else payload for payload in payloads])
+    bad = batcher.submit(1, 'bad')
+    good = batcher.submit(2, 'good')
+    batcher.start()
+
+    assert good.result(timeout=10) == 'good'
+    with pytest.raises(ValueError):
+        bad.result(timeout=10)
+
+
+def test_full_queue_rejects_without_leaking():
+    batcher, _ = echo_batcher(maxsize=1)
+    batcher.submit(1, 'queued')
+    with pytest.raises(Full):
+        batcher.submit(2, 'rejected')
+    assert list(batcher.pending) == [1]
+
+
+def test_failing_queue_rejects_without_leaking():
+    class FailingQueue(Queue):
+        def _put(self, item):
+            raise TypeError('cannot order this item')
+
+    batcher = MicroBatcher(FailingQueue(), None)
+    with pytest.raises(TypeError):
+        batcher.submit(1, 'payload')
+    assert batcher.pending == {}
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Coalescing and caching of identical requests
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+
+from GODEL.utils.cache import ResponseCache
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_identical_requests_share_one_generation():
+    cache = ResponseCache()
+    key = ResponseCache.key('hello  there', 'knowledge')
+    release = Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(timeout=10)
+        return {'response': 'hi'}
+
+    with ThreadPoolExecutor(4) as executor:
+        owner = executor.submit(cache.get_or_compute, key, compute)
+        wait_for(lambda: calls)
+        waiters = [executor.submit(cache.get_or_compute, key, compute) for _ in range(3)]
+        wait_for(lambda: cache.coalesced == 3)
+        release.set()
+        results = [future.result(timeout=10) for future in [owner] + waiters]
+
+    assert results == [{'response': 'hi'}] * 4
+    assert len(calls) == 1
+    # cached afterwards, under the normalized context
+    assert cache.get_or_compute(ResponseCache.key('hello there', 'knowledge'), compute) == {'response': 'hi'}
+    assert len(calls) == 1
+
+
+def test_coalesced_requests_share_the_error():
+    cache = ResponseCache()
+    release = Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(timeout=10)
+        raise ValueError('generation failed')
+
+    with ThreadPoolExecutor(2) as executor:
+        owner = executor.submit(cache.get_or_compute, 'key', compute)
+        wait_for(lambda: calls)
+        waiter = executor.submit(cache.get_or_compute, 'key', compute)
+        wait_for(lambda: cache.coalesced == 1)
+        release.set()
+        for future in (owner, waiter):
+            with pytest.raises(ValueError):
+                future.result(timeout=10)
+
+    # failures are not cached
+    release.set()
+    with pytest.raises(ValueError):
+        cache.get_or_compute('key', compute)
+    assert len(calls) == 2
+
+
+def test_sampled_responses_are_not_cached_by_default():
+    assert ResponseCache().is_cacheable({'num_beams': 4})
+    assert not ResponseCache().is_cacheable({'do_sample': True})
+    assert ResponseCache(cache_sampling=True).is_cacheable({'do_sample': True})
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+The engine, static and speculative decoders give the same outputs as
+`generate()`
+"""
+
+import pytest
+import torch
+from transformers import AutoModelForSeq2SeqLM
+
+from GODEL.utils.continuous_batching import ContinuousBatchingEngine
+from GODEL.utils.speculative import SpeculativeDecoder
+from GODEL.utils.static_decoding import StaticT5Decoder
+
+CONTEXTS = ['hello there', 'what is the model trained on EOS dialog data', 'GODEL ' * 20]
+PARAMS = [
+    {'max_length': 20, 'min_length': 5, 'no_repeat_ngram_size': 3},
+    {'max_length': 40, 'min_length': 0, 'no_repeat_ngram_size': 0},
+]
+
+
+def stock_generate(server, params, contexts=CONTEXTS):
+    encodings = server.pad_inputs(server.encode_batch(contexts, ['some knowledge'] * len(contexts)))
+    output_ids = server.model.generate(encodings.input_ids, attention_mask=encodings.attention_mask,
+                                       **server.get_gen_kwargs(params))
+    return encodings, output_ids
+
+
+def stock_responses(server, params):
+    # one call per context, like the decoders that run unpadded rows
+    return [server.tokenizer.decode(stock_generate(server, params, [context])[1][0], skip_special_tokens=True)
+            for context in CONTEXTS]
+
+
+@pytest.mark.parametrize('num_beams', [1, 3])
+@pytest.mark.parametrize('params', PARAMS)
+def test_static_decoder(tiny_server, params, num_beams):
+    params = dict(params, num_beams=num_beams)
+    encodings, expected = stock_generate(tiny_server, params)
+    decoder = StaticT5Decoder(tiny_server.model, max_length=64)
+    output_ids = decoder.generate(encodings.input_ids, attention_mask=encodings.attention_mask,
+                                  **tiny_server.get_gen_kwargs(params))
+    assert torch.equal(output_ids, expected)
+
+
+@pytest.mark.parametrize('params', PARAMS)
+def test_speculative_decoder(tiny_server, tiny_checkpoints, params):
+    encodings, _ = stock_generate(tiny_server, params)
+    draft_model = AutoModelForSeq2SeqLM.from_pretrained(tiny_checkpoints['draft']).eval()
+    decoder = SpeculativeDecoder(tiny_server.model, draft_model, num_speculative_tokens=3)
+    output_ids = decoder.generate(encodings.input_ids, attention_mask=encodings.attention_mask,
+                                  **tiny_server.get_gen_kwargs(params))
+    assert tiny_server.tokenizer.batch_decode(output_ids, skip_special_tokens=True) == \
+        stock_responses(tiny_server, params)
+
+
+def test_continuous_batching_engine(tiny_server):
+    engine = ContinuousBatchingEngine(tiny_server.model, tiny_server.tokenizer, max_batch_size=2)
+    engine.start()
+    # more requests than batch slots, with different params, so sequences
+    # join and leave the running batch
+    requests = [(context, params) for context in CONTEXTS for params in PARAMS]
+    futures = [engine.submit(tiny_server.encode_batch([context], ['some knowledge'])[0],
+                             tiny_server.get_gen_kwargs(params))
+               for context, params in requests]
+    expected = [stock_responses(tiny_server, params) for params in PARAMS]
+    assert [future.result(timeout=60) for future in futures] == \
+        [expected[PARAMS.index(params)][CONTEXTS.index(context)] for context, params in requests]
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Token budgets of the encoder inputs
+"""
+
+import pytest
+from transformers import AutoTokenizer
+
+from GODEL.utils.input_builder import InputBuilder
+
+TURNS = [' hello there ', 'how was the training? ']
+
+
+@pytest.fixture(scope='module')
+def tokenizer(tiny_checkpoints):
+    return AutoTokenizer.from_pretrained(tiny_checkpoints['model'])
+
+
+@pytest.mark.parametrize('max_context_length', [None, 100])
+def test_same_ids_as_the_joined_string(tokenizer, max_context_length):
+    builder = InputBuilder(tokenizer, max_context_length=max_context_length)
+    joined = ' EOS '.join(turn.strip() for turn in TURNS) + ' <|knowledge|> some knowledge =>'
+    assert builder.build(TURNS, ' some knowledge ') == tokenizer(joined).input_ids
+    assert builder.build(turn_ids=builder.encode_turns(TURNS), knowledge='some knowledge') == \
+        tokenizer(joined).input_ids
+
+
+def test_max_length_keeps_the_markers(tokenizer):
+    builder = InputBuilder(tokenizer, max_context_length=20, max_length=40)
+    end_ids = builder.end_marker_ids + [tokenizer.eos_token_id]
+
+    input_ids = builder.build(TURNS, 'long knowledge ' * 50)
+    assert len(input_ids) == 40
+    assert input_ids[-len(end_ids):] == end_ids
+    # the context is kept, the knowledge is cut
+    assert input_ids[:len(builder.context_ids(TURNS))] == builder.context_ids(TURNS)
+
+    input_ids = builder.build(TURNS * 20, 'knowledge', use_knowledge=False)
+    assert len(input_ids) <= 40
+    assert input_ids[-len(end_ids):] == end_ids
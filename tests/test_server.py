@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Malformed requests to the example server get a 4xx before reaching the
+generation workers
+"""
+
+import json
+
+import pytest
+
+VALID = {'msg': ['hello there'], 'knowledge': 'some knowledge', 'params': {'max_length': 40}}
+
+INVALID = [
+    [1],
+    {'msg': 'hello', 'knowledge': 'k'},
+    {'msg': [5], 'knowledge': 'k'},
+    {'msg': ['hello']},
+    {'msg': ['hello'], 'knowledge': 5},
+    {'msg': ['hello'], 'knowledge_ids': ['doc']},
+    dict(VALID, params=[1]),
+    dict(VALID, params={'max_length': 'x'}),
+    dict(VALID, params={'max_length': 0}),
+    dict(VALID, params={'num_beams': True}),
+    dict(VALID, params={'top_p': 2}),
+    dict(VALID, params={'temperature': -1}),
+    dict(VALID, params={'do_sample': 1}),
+    dict(VALID, params={'min_length': 50, 'max_length': 40}),
+    dict(VALID, model=['x']),
+    dict(VALID, session_id=[1]),
+    dict(VALID, priority=['x']),
+    dict(VALID, priority='unknown'),
+    dict(VALID, timeout='abc'),
+    dict(VALID, timeout=-1),
+    dict(VALID, timeout=10 ** 9),
+]
+
+
+@pytest.mark.parametrize('in_request', INVALID)
+@pytest.mark.parametrize('path', ['/generate', '/generate_stream'])
+def test_invalid_request(client, path, in_request):
+    response = client.post(path, json=in_request)
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+
+def test_unknown_model(client):
+    response = client.post('/generate', json=dict(VALID, model='unknown'))
+    assert response.status_code == 404
+
+
+def test_valid_request(client, tiny_server):
+    response = client.post('/generate', json=VALID)
+    assert response.status_code == 200
+    assert response.json['response'] == tiny_server.generate(' EOS '.join(VALID['msg']), VALID['knowledge'],
+                                                              params=VALID['params'])[0]
+
+
+def test_bulk_errors_stay_per_item(client):
+    items = [5, VALID, {'msg': 'abc', 'knowledge': 'k'}, dict(VALID, params={'max_length': 'x'}), VALID]
+    response = client.post('/generate_batch', json=items)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [line['index'] for line in lines] == list(range(len(items)))
+    assert ['response' in line for line in lines] == [False, True, False, False, True]
+    assert lines[1]['response'] == lines[4]['response']
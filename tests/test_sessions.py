@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+#  coding=utf-8
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT license.
+"""
+Session histories stay stored when they outgrow the store
+"""
+
+import pytest
+
+from GODEL.utils.sessions import SessionStore
+
+
+def test_oversized_session_drops_oldest_turns():
+    # 40 bytes hold three turns of three 4-byte ids
+    sessions = SessionStore(max_bytes=40)
+    session_id = sessions.create()
+    for turn in range(5):
+        history = sessions.append(session_id, [[turn] * 3])
+    assert history == [[2] * 3, [3] * 3, [4] * 3]
+    # the history returned is the one stored for the next turn
+    assert sessions.append(session_id, [[5]]) == [[2] * 3, [3] * 3, [4] * 3, [5]]
+
+
+def test_turns_larger_than_the_store_are_rejected():
+    sessions = SessionStore(max_bytes=40)
+    session_id = sessions.create()
+    sessions.append(session_id, [[1] * 3])
+    with pytest.raises(ValueError):
+        sessions.append(session_id, [[2] * 20])
+    assert sessions.append(session_id, [[3]]) == [[1] * 3, [3]]